@@ -2,18 +2,37 @@ import os
 import json
 import uuid
 import time
+import hashlib
+import hmac
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from contextlib import contextmanager
+import re
+import zlib
+import queue
+import asyncio
+import select
+import threading
+import multiprocessing
+from collections import OrderedDict
 from datetime import datetime, timezone,timedelta
 from pathlib import Path
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict, Tuple, Iterable, Iterator
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response, FileResponse, RedirectResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field, EmailStr
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import IntegrityError, OperationalError
 from passlib.context import CryptContext
 from jose import jwt, JWTError
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 # -----------------------------
 # アプリDB（業務データ＋一般ユーザー）
@@ -31,10 +50,65 @@ DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 # -----------------------------
 ADMIN_AUTH_DATABASE_URL = os.getenv("ADMIN_AUTH_DATABASE_URL", DATABASE_URL)
 
+# -----------------------------
+# 読み取り専用レプリカ（任意。未設定なら primary をそのまま使う）
+#   REPLICA_RYW_SECONDS    : 自分の書き込み後この秒数は LSN を確認し、未反映なら primary で読む
+#   REPLICA_MAX_LAG_SECONDS: 再生遅延がこれを超えたら primary で読む（0 で無効）
+#   ※ レプリカでない Postgres を代役にした場合、LSN 確認付きの読み取りは常に primary になる
+# -----------------------------
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL")
+ADMIN_AUTH_REPLICA_URL = os.getenv("ADMIN_AUTH_REPLICA_URL")
+REPLICA_RYW_SECONDS = int(os.getenv("REPLICA_RYW_SECONDS", "30"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "0"))
+
 # アップロード保存先（環境変数で上書き可）
 UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "./uploads"))
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# ★ ファイル保存バックエンド: local（UPLOAD_DIR）/ s3（S3 互換。MinIO 等）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")          # MinIO なら http://minio:9000
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+S3_PUBLIC_BASE_URL = os.getenv("S3_PUBLIC_BASE_URL")    # 未設定なら {endpoint}/{bucket}
+UPLOAD_PRESIGN_SECONDS = int(os.getenv("UPLOAD_PRESIGN_SECONDS", "900"))
+# 直接アップロードの受け口。登録（claim）までは /uploads で公開しない（S3 は同じバケットの incoming/）
+UPLOAD_INCOMING_DIR = Path(os.getenv("UPLOAD_INCOMING_DIR", "./uploads_incoming"))
+UPLOAD_INCOMING_DIR.mkdir(parents=True, exist_ok=True)
+UPLOAD_INCOMING_PREFIX = "incoming/"
+if UPLOAD_INCOMING_DIR.resolve().is_relative_to(UPLOAD_DIR.resolve()):
+    raise RuntimeError("UPLOAD_INCOMING_DIR must be outside UPLOAD_DIR (it is served at /uploads)")
+
+# ★ 音声処理（ffprobe / ffmpeg）。AUDIO_WORKERS は同時に走らせる ffmpeg プロセス数
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "2"))
+AUDIO_LOUDNORM = os.getenv("AUDIO_LOUDNORM", "I=-16:TP=-1.5:LRA=11")
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "128k")
+AUDIO_TIMEOUT_SECONDS = int(os.getenv("AUDIO_TIMEOUT_SECONDS", "600"))
+
+# ★ 孤立ファイルの回収: 猶予秒数・DB 照合の 1 回あたり件数・定期実行間隔（0 で無効）と処理方法
+STORAGE_GC_GRACE_SECONDS = int(os.getenv("STORAGE_GC_GRACE_SECONDS", "86400"))
+STORAGE_GC_BATCH_SIZE = int(os.getenv("STORAGE_GC_BATCH_SIZE", "1000"))
+STORAGE_GC_INTERVAL_SECONDS = int(os.getenv("STORAGE_GC_INTERVAL_SECONDS", "0"))
+STORAGE_GC_ACTION = os.getenv("STORAGE_GC_ACTION", "report")   # report / quarantine / delete
+# 隔離先。/uploads で公開される UPLOAD_DIR の外に置く（S3 は別バケットを指定可。省略時は同じバケットの .quarantine/）
+STORAGE_QUARANTINE_DIR = Path(os.getenv("STORAGE_QUARANTINE_DIR", "./quarantine"))
+STORAGE_QUARANTINE_BUCKET = os.getenv("STORAGE_QUARANTINE_BUCKET", "")
+if STORAGE_QUARANTINE_DIR.resolve().is_relative_to(UPLOAD_DIR.resolve()):
+    raise RuntimeError("STORAGE_QUARANTINE_DIR must be outside UPLOAD_DIR (it is served at /uploads)")
+
+# ★ 文字入れ済み画像（サーバ側合成）のキャッシュ
+RENDER_CACHE_DIR = Path(os.getenv("RENDER_CACHE_DIR", "./render_cache"))
+RENDER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+RENDER_MAX_WIDTH = int(os.getenv("RENDER_MAX_WIDTH", "1920"))
+RENDER_BASE_WIDTH = int(os.getenv("RENDER_BASE_WIDTH", "500"))   # fontSize(px) を決めたプレビュー幅
+RENDER_FONT_PATH = os.getenv("RENDER_FONT_PATH", "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc")
+RENDER_FONT_BOLD_PATH = os.getenv("RENDER_FONT_BOLD_PATH", "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc")
+RENDER_FAIL_RETRY_SECONDS = int(os.getenv("RENDER_FAIL_RETRY_SECONDS", "300"))   # 失敗したキーを再試行しない秒数
+
 API_ORIGIN = os.getenv("API_ORIGIN", "*")
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-change-me")  # 本番は強い値に
 JWT_ALG = os.getenv("JWT_ALG", "HS256")
@@ -57,8 +131,38 @@ SMTP_FROM_NAME = (
     or "Fricsignage"
 )
 
+# ★ SSE: 無通信時のハートビート間隔（秒）と購読者ごとのキュー上限
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+SSE_QUEUE_MAX = int(os.getenv("SSE_QUEUE_MAX", "256"))
+
+# ★ 稼働率集計用: 1 スロットの長さ（分）と営業時間 [OPEN_HOUR, CLOSE_HOUR)
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", "30"))
+OPEN_HOUR = int(os.getenv("OPEN_HOUR", "8"))
+CLOSE_HOUR = int(os.getenv("CLOSE_HOUR", "23"))
+# ★ 集計の差分（stats_*_delta）をロールアップへ畳み込む間隔（秒）
+STATS_FOLD_INTERVAL_SECONDS = int(os.getenv("STATS_FOLD_INTERVAL_SECONDS", "30"))
+
+# ★ 繰り返し指定の上限日数と、スロット一括 INSERT/照合の 1 回あたり件数
+RECURRENCE_MAX_DAYS = int(os.getenv("RECURRENCE_MAX_DAYS", "366"))
+SLOT_CHUNK_SIZE = int(os.getenv("SLOT_CHUNK_SIZE", "5000"))
+
+# ★ 再生マニフェスト: 保持する版数と、プロセス内キャッシュの有効秒数
+MANIFEST_KEEP_VERSIONS = int(os.getenv("MANIFEST_KEEP_VERSIONS", "10"))
+MANIFEST_CACHE_SECONDS = float(os.getenv("MANIFEST_CACHE_SECONDS", "5"))
+MANIFEST_CACHE_MAX_ENTRIES = int(os.getenv("MANIFEST_CACHE_MAX_ENTRIES", "1024"))
+# 再生端末が問い合わせてよい kind（これ以外は保存せず空のマニフェストを返す）
+PLAYBACK_KINDS = tuple(k.strip() for k in os.getenv("PLAYBACK_KINDS", "アドトラック,大型ビジョン,サイネージ").split(",") if k.strip())
+
+# ★ エクスポート: COPY の読み出し単位と、送信待ちで溜める最大チャンク数（メモリ上限 ≒ 積）
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+EXPORT_QUEUE_CHUNKS = int(os.getenv("EXPORT_QUEUE_CHUNKS", "16"))
+
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 engine_admin = create_engine(ADMIN_AUTH_DATABASE_URL, pool_pre_ping=True)
+engine_ro = create_engine(REPLICA_DATABASE_URL, pool_pre_ping=True) if REPLICA_DATABASE_URL else engine
+engine_admin_ro = (
+    create_engine(ADMIN_AUTH_REPLICA_URL, pool_pre_ping=True) if ADMIN_AUTH_REPLICA_URL else engine_admin
+)
 pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 app = FastAPI(title="fricsignage API")
@@ -83,7 +187,452 @@ def send_mail(to_addr: str, subject: str, body: str) -> None:
         s.login(SMTP_USER, SMTP_PASS)
         s.sendmail(SMTP_FROM_ADDR, [to_addr], msg.as_string())
 
+# ---- ファイル保存バックエンド ----
+#   submission_files.path には local は "<UPLOAD_DIR>/<key>"、s3 は "s3://<bucket>/<key>" を入れる
+_UPLOAD_KEY_RE = re.compile(r"^[0-9a-f]{32}(\.[0-9a-z]{1,10})?$")
+
+def new_upload_key(filename: Optional[str]) -> str:
+    ext = (Path(filename or "").suffix or "").lower()
+    if not re.match(r"^\.[0-9a-z]{1,10}$", ext):
+        ext = ""
+    return f"{uuid.uuid4().hex}{ext}"
+
+def _storage_key(path: str) -> str:
+    """submission_files.path → ストレージ上の key（s3://bucket/ の後ろ、ローカルはファイル名）"""
+    if path.startswith("s3://"):
+        return path.split("/", 3)[3] if path.count("/") >= 3 else ""
+    return Path(path).name
+
+def _storage_key_sql(col: str) -> str:
+    """_storage_key と同じ変換を SQL 式で（idx_submission_files_key と同じ式にすること）"""
+    return (f"(CASE WHEN {col} LIKE 's3://%' THEN regexp_replace({col}, '^s3://[^/]+/', '') "
+            f"ELSE regexp_replace({col}, '^.*/', '') END)")
+
+def _sign_direct_upload(key: str, exp: int, content_type: str) -> str:
+    msg = f"{key}:{exp}:{content_type}".encode("utf-8")
+    return hmac.new(JWT_SECRET.encode("utf-8"), msg, hashlib.sha256).hexdigest()
+
+def _media_token(submission_id: int) -> str:
+    """申請者だけが自分の申請の処理状況を見られるようにするトークン（申請時のレスポンスで返す）"""
+    msg = f"submission-media:{int(submission_id)}".encode("utf-8")
+    return hmac.new(JWT_SECRET.encode("utf-8"), msg, hashlib.sha256).hexdigest()
+
+class LocalStorage:
+    """UPLOAD_DIR に保存。直接アップロードは署名付き PUT /api/uploads/direct/{key} で incoming に受ける"""
+
+    def __init__(self, root: Path, incoming: Path):
+        self.root = root
+        self.incoming = incoming
+
+    def save(self, key: str, fileobj, content_type: str = "") -> Tuple[str, int]:
+        dest = self.root / key
+        with dest.open("wb") as out:
+            shutil.copyfileobj(fileobj, out)
+        return str(dest), dest.stat().st_size
+
+    def path_for_key(self, key: str) -> str:
+        return str(self.root / key)
+
+    def stat(self, key: str) -> Optional[int]:
+        try:
+            return (self.root / key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def claim(self, key: str) -> Optional[Tuple[str, int]]:
+        """
+        incoming に直接アップロードされた key をサーバ側で採番した key に移して (path, size) を返す（無ければ None）。
+        署名付き URL は期限まで何度でも PUT できるので、登録後に中身を差し替えられないようにする。
+        登録済みのファイル（UPLOAD_DIR 側）は対象にしない
+        """
+        dest = self.root / new_upload_key(key)
+        try:
+            # incoming が別のファイルシステムでも動くように rename ではなく move
+            shutil.move(str(self.incoming / key), dest)
+        except FileNotFoundError:
+            return None
+        return str(dest), dest.stat().st_size
+
+    def url(self, path: str) -> str:
+        return f"{API_ORIGIN}/uploads/{Path(path).name}"
+
+    def _file(self, path: str) -> Path:
+        # 行の path は "./uploads/x.png" や絶対パスなど書き方が揺れるので、URL と同じくファイル名で引く
+        # （iter_objects が返す incoming のファイルだけは incoming で引く）
+        p = Path(path)
+        if p.parent.resolve() == self.incoming.resolve():
+            return self.incoming / p.name
+        return self.root / _storage_key(path)
+
+    @contextmanager
+    def local_copy(self, path: str):
+        yield str(self._file(path))
+
+    def delete(self, path: str) -> None:
+        self._file(path).unlink(missing_ok=True)
+
+    def exists(self, path: str) -> bool:
+        return self._file(path).exists()
+
+    def iter_objects(self) -> Iterator[Tuple[str, int, float]]:
+        """(path, size, mtime) を逐次返す（UPLOAD_DIR と incoming の直下のみ。サブディレクトリは対象外）"""
+        for root in (self.root, self.incoming):
+            with os.scandir(root) as it:
+                for e in it:
+                    if not e.is_file(follow_symlinks=False):
+                        continue
+                    st = e.stat(follow_symlinks=False)
+                    yield str(root / e.name), st.st_size, st.st_mtime
+
+    def quarantine(self, path: str) -> None:
+        STORAGE_QUARANTINE_DIR.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(self._file(path)), STORAGE_QUARANTINE_DIR / _storage_key(path))
+
+    def presign_put(self, key: str, content_type: str) -> Dict:
+        exp = int(time.time()) + UPLOAD_PRESIGN_SECONDS
+        sig = _sign_direct_upload(key, exp, content_type)
+        return {
+            "url": f"{API_ORIGIN}/api/uploads/direct/{key}?exp={exp}&sig={sig}",
+            "method": "PUT",
+            "headers": {"Content-Type": content_type},
+        }
+
+class S3Storage:
+    """S3 互換ストレージ（boto3 は使うときだけ import）"""
+
+    def __init__(self):
+        import boto3
+        from botocore.config import Config
+
+        if not S3_BUCKET:
+            raise RuntimeError("S3_BUCKET is required for STORAGE_BACKEND=s3")
+        self.bucket = S3_BUCKET
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            aws_access_key_id=S3_ACCESS_KEY,
+            aws_secret_access_key=S3_SECRET_KEY,
+            config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+        )
+        base = S3_PUBLIC_BASE_URL or f"{(S3_ENDPOINT_URL or 'https://s3.amazonaws.com').rstrip('/')}/{self.bucket}"
+        self.public_base = base.rstrip("/")
+
+    def save(self, key: str, fileobj, content_type: str = "") -> Tuple[str, int]:
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra)
+        return self.path_for_key(key), self.stat(key) or 0
+
+    def path_for_key(self, key: str) -> str:
+        return f"s3://{self.bucket}/{key}"
+
+    def stat(self, key: str) -> Optional[int]:
+        from botocore.exceptions import ClientError
+        try:
+            return int(self.client.head_object(Bucket=self.bucket, Key=key)["ContentLength"])
+        except ClientError:
+            return None
+
+    def claim(self, key: str) -> Optional[Tuple[str, int]]:
+        """LocalStorage.claim と同じ。incoming/ からサーバ側コピーで新しい key に移し、元の key は消す"""
+        from botocore.exceptions import ClientError
+        new_key = new_upload_key(key)
+        src = UPLOAD_INCOMING_PREFIX + key
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=new_key,
+                                    CopySource={"Bucket": self.bucket, "Key": src})
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        self.client.delete_object(Bucket=self.bucket, Key=src)
+        return self.path_for_key(new_key), self.stat(new_key) or 0
+
+    def url(self, path: str) -> str:
+        return f"{self.public_base}/{self._key(path)}"
+
+    def _key(self, path: str) -> str:
+        return _storage_key(path)
+
+    @contextmanager
+    def local_copy(self, path: str):
+        """処理用に一時ファイルへ落とす（抜けたら削除）"""
+        fd, tmp = tempfile.mkstemp(suffix=Path(path).suffix)
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self._key(path), tmp)
+            yield tmp
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+
+    def delete(self, path: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(path))
+
+    def exists(self, path: str) -> bool:
+        return self.stat(self._key(path)) is not None
+
+    def iter_objects(self) -> Iterator[Tuple[str, int, float]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket):
+            for o in page.get("Contents", []):
+                if o["Key"].startswith(".quarantine/"):
+                    continue
+                yield self.path_for_key(o["Key"]), int(o["Size"]), o["LastModified"].timestamp()
+
+    def quarantine(self, path: str) -> None:
+        key = self._key(path)
+        if STORAGE_QUARANTINE_BUCKET:
+            dest = {"Bucket": STORAGE_QUARANTINE_BUCKET, "Key": key}
+        else:
+            # 同じバケットに置く場合は、公開ポリシーを uploads 側だけに絞っておくこと
+            dest = {"Bucket": self.bucket, "Key": f".quarantine/{key}"}
+        self.client.copy_object(**dest, CopySource={"Bucket": self.bucket, "Key": key})
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def presign_put(self, key: str, content_type: str) -> Dict:
+        # 公開ポリシーは incoming/ を除いておくこと
+        url = self.client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": UPLOAD_INCOMING_PREFIX + key, "ContentType": content_type},
+            ExpiresIn=UPLOAD_PRESIGN_SECONDS,
+        )
+        return {"url": url, "method": "PUT", "headers": {"Content-Type": content_type}}
+
+local_storage = LocalStorage(UPLOAD_DIR, UPLOAD_INCOMING_DIR)
+storage = S3Storage() if STORAGE_BACKEND == "s3" else local_storage
+
+# ---- レプリカ振り分け（read-your-writes）----
+#   書き込み後に primary の WAL 位置を Cookie / X-Write-LSN で返し、
+#   読み取り時に Cookie / X-Min-LSN の位置までレプリカが再生済みかを確認する
+LSN_COOKIE = "fs_lsn"
+ADMIN_LSN_COOKIE = "fs_admin_lsn"
+_LSN_RE = re.compile(r"^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$")
+
+def _min_lsn(request: Request, cookie: str) -> Optional[str]:
+    v = request.headers.get("x-min-lsn") or request.cookies.get(cookie)
+    return v if v and _LSN_RE.match(v) else None
+
+def pick_read_engine(primary, replica, min_lsn: Optional[str] = None):
+    """読み取りに使う engine を返す（レプリカが遅れている・落ちている場合は primary）"""
+    if replica is primary:
+        return primary
+    if min_lsn is None and REPLICA_MAX_LAG_SECONDS <= 0:
+        return replica
+    try:
+        with replica.connect() as conn:
+            ok = conn.execute(text("""
+                SELECT (CAST(:lsn AS TEXT) IS NULL
+                        OR COALESCE(pg_last_wal_replay_lsn() >= CAST(CAST(:lsn AS TEXT) AS pg_lsn), FALSE))
+                   AND (:max_lag <= 0
+                        OR COALESCE(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) <= :max_lag)
+            """), {"lsn": min_lsn, "max_lag": REPLICA_MAX_LAG_SECONDS}).scalar()
+    except OperationalError:
+        return primary
+    return replica if ok else primary
+
+def read_with_fallback(fn, primary=None, replica=None, min_lsn: Optional[str] = None):
+    """
+    fn(conn) をレプリカで実行し、接続断などの OperationalError なら primary でやり直す。
+    fn は読み取り専用（2 回呼ばれてもよい）こと。
+    """
+    primary = primary or engine
+    replica = replica or engine_ro
+    eng = pick_read_engine(primary, replica, min_lsn)
+    if eng is not primary:
+        try:
+            with eng.begin() as conn:
+                return fn(conn)
+        except OperationalError as e:
+            print("replica read failed, retrying on primary:", e)
+    with primary.begin() as conn:
+        return fn(conn)
+
+def remember_write(response: Response, primary, cookie: str) -> None:
+    """コミット後に呼ぶ。レプリカ未設定なら何もしない"""
+    replica = engine_ro if primary is engine else engine_admin_ro
+    if replica is primary:
+        return
+    with primary.connect() as conn:
+        lsn = conn.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+    response.headers["X-Write-LSN"] = lsn
+    response.set_cookie(cookie, lsn, max_age=REPLICA_RYW_SECONDS, httponly=True, samesite="lax")
+
+# ---- LISTEN/NOTIFY 購読ハブ ----
+class NotifyHub:
+    """
+    Postgres の LISTEN をワーカーごとに 1 本の専用接続で受け、
+    SSE 購読者（asyncio.Queue）へ配る。
+    - 受信はバックグラウンドスレッド（select で待機）
+    - payload の変換と SSE フレーム生成は 1 イベントにつき 1 回だけ行う
+      変換は channel ごとの 1 本のスレッドで順に行い（DB を引く変換で受信や他 channel を止めない）、
+      購読者がいない channel は変換しない
+    - 詰まった購読者はキューを捨てて None（resync 指示）を積む
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.transforms: Dict[str, object] = {}
+        self.subscribers: Dict[str, set] = {}
+        self._workers: Dict[str, ThreadPoolExecutor] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, channel: str, transform=None) -> None:
+        """channel を購読対象にする。transform(payload:str) -> dict|None（None なら配信しない）"""
+        self.transforms[channel] = transform or json.loads
+        self.subscribers.setdefault(channel, set())
+        self._workers.setdefault(channel, ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"notify-{channel}"))
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self._thread is not None or not self.transforms:
+            return
+        self.loop = loop
+        self._thread = threading.Thread(target=self._run, name="notify-hub", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    # 以下 2 つはイベントループ上からのみ呼ぶ
+    def subscribe(self, channel: str) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_MAX)
+        self.subscribers[channel].add(q)
+        return q
+
+    def unsubscribe(self, channel: str, q: asyncio.Queue) -> None:
+        self.subscribers.get(channel, set()).discard(q)
+
+    def _fanout(self, channel: str, item) -> None:
+        for q in list(self.subscribers.get(channel, ())):
+            if item is not None:
+                try:
+                    q.put_nowait(item)
+                    continue
+                except asyncio.QueueFull:
+                    pass
+            # 取りこぼし（滞留 or 再接続）: 溜まった分を捨てて再取得を促す
+            while not q.empty():
+                q.get_nowait()
+            q.put_nowait(None)
+
+    def _dispatch(self, channel: str, payload: str) -> None:
+        # 受信スレッド側。購読者がいなければ何もしない（len はロック無しで読んでよい）
+        if channel not in self._workers or not self.subscribers.get(channel):
+            return
+        self._workers[channel].submit(self._deliver, channel, payload)
+
+    def _deliver(self, channel: str, payload: str) -> None:
+        if not self.subscribers.get(channel):
+            return
+        transform = self.transforms[channel]
+        try:
+            data = transform(payload)
+        except Exception as e:
+            print("notify transform failed:", channel, e)
+            return
+        if not data:
+            return
+        frame = f"event: {data.get('event', 'message')}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self.loop.call_soon_threadsafe(self._fanout, channel, (data, frame))
+
+    def _run(self) -> None:
+        first = True
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    for ch in self.transforms:
+                        cur.execute(f'LISTEN "{ch}"')
+                if not first:
+                    # 切断中のイベントは失われるので全購読者に resync
+                    for ch in self.transforms:
+                        self.loop.call_soon_threadsafe(self._fanout, ch, None)
+                first = False
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        self._dispatch(n.channel, n.payload)
+            except psycopg2.Error as e:
+                print("notify hub connection error:", e)
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+notify_hub = NotifyHub(DATABASE_URL)
+
+def sse_response(request: Request, channel: str, accept=None) -> StreamingResponse:
+    """notify_hub の channel を SSE で流す。accept(data) が False のイベントは送らない"""
+    q = notify_hub.subscribe(channel)
+
+    async def gen():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    item = await asyncio.wait_for(q.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    yield "event: resync\ndata: {}\n\n"
+                    continue
+                data, frame = item
+                if accept is None or accept(data):
+                    yield frame
+        finally:
+            notify_hub.unsubscribe(channel, q)
+
+    return StreamingResponse(
+        gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ---- 起動時初期化（DB接続の待機＋スキーマ作成）----
+
+# schedule_json → reservation_slots。JSON 展開から INSERT まで SQL 1 文で行う。
+# 従来の Python ループと同じく全申請の全スロットを ON CONFLICT DO NOTHING で流すので、
+# 一部だけ登録済みの申請も残りが埋まる（"HH:MM" 判定は len==5 and t[2]==':' と同じ条件）
+# 起動時に schema_migrations の印を見て 1 回だけ実行する。同値性は scripts/check_schedule_equivalence.py で確認する
+BACKFILL_SLOTS_SQL = """
+INSERT INTO reservation_slots(kind, day, time, submission_id)
+SELECT s.kind, d.key::date, (t.value #>> '{}')::time, s.id
+  FROM submissions s
+  CROSS JOIN LATERAL jsonb_each(
+    CASE WHEN jsonb_typeof(s.schedule_json) = 'object' THEN s.schedule_json ELSE '{}'::jsonb END
+  ) d
+  CROSS JOIN LATERAL jsonb_array_elements(
+    CASE WHEN jsonb_typeof(d.value) = 'array' THEN d.value ELSE '[]'::jsonb END
+  ) t
+ WHERE jsonb_typeof(t.value) = 'string'
+   AND length(t.value #>> '{}') = 5 AND substr(t.value #>> '{}', 3, 1) = ':'
+ ORDER BY s.id
+ON CONFLICT (kind, day, time) DO NOTHING
+"""
+
+SUBMISSION_SCHEDULES_VIEW_SQL = """
+CREATE OR REPLACE VIEW submission_schedules AS
+SELECT submission_id,
+       jsonb_object_agg(day::text, times) AS schedule
+  FROM (
+    SELECT submission_id, day,
+           jsonb_agg(to_char(time, 'HH24:MI') ORDER BY time) AS times
+      FROM reservation_slots
+     GROUP BY submission_id, day
+  ) d
+ GROUP BY submission_id;
+"""
+
 def init_app_db_with_retry():
     # アプリDB待機
     for _ in range(30):
@@ -241,6 +790,14 @@ def init_app_db_with_retry():
           ) THEN
             ALTER TABLE submissions ADD COLUMN overlay JSONB NULL;
           END IF;
+
+          -- ★ 追加: 繰り返し指定（recurrence）で申請された場合のルール
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submissions' AND column_name='schedule_rule'
+          ) THEN
+            ALTER TABLE submissions ADD COLUMN schedule_rule JSONB NULL;
+          END IF;
         END $$;
         """))
 
@@ -255,6 +812,75 @@ def init_app_db_with_retry():
             size BIGINT
         );
         """))
+        # ★ 追加: 音声処理の状態とメタデータ（音声以外は media_status = NULL）
+        conn.execute(text("""
+        DO $$
+        BEGIN
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='media_status'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN media_status TEXT NULL;
+            CREATE INDEX IF NOT EXISTS idx_submission_files_media_status
+              ON submission_files(media_status) WHERE media_status IN ('pending', 'processing');
+          END IF;
+
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='media_error'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN media_error TEXT NULL;
+          END IF;
+
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='media_meta'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN media_meta JSONB NULL;
+          END IF;
+
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='duration_sec'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN duration_sec DOUBLE PRECISION NULL;
+          END IF;
+
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='codec'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN codec TEXT NULL;
+          END IF;
+
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='media_updated_at'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN media_updated_at TIMESTAMPTZ NULL;
+          END IF;
+
+          -- ★ 追加: 実ファイルが見つからない行の印（ストレージ照合で設定/解除）
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='submission_files' AND column_name='missing_since'
+          ) THEN
+            ALTER TABLE submission_files ADD COLUMN missing_since TIMESTAMPTZ NULL;
+          END IF;
+        END $$;
+        """))
+
+        # ストレージ照合用。path の書き方（./uploads/x, /srv/uploads/x, s3://bucket/x）に依らず key で引く
+        conn.execute(text(f"""
+        CREATE INDEX IF NOT EXISTS idx_submission_files_key
+          ON submission_files({_storage_key_sql("path")});
+        """))
+
+        # 申請ごとの先頭ファイル取得（ORDER BY id LIMIT 1）を索引で引く
+        conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_submission_files_submission
+          ON submission_files(submission_id, id);
+        """))
 
         # 予約スロット（kind×day×time で一意）
         conn.execute(text("""
@@ -268,23 +894,250 @@ def init_app_db_with_retry():
         );
         """))
 
-        # 既存 submissions の schedule_json からバックフィル（安全に重複回避）
-        rows = conn.execute(text("SELECT id, kind, schedule_json FROM submissions")).mappings().all()
-        for r in rows:
-            sid = int(r["id"])
-            k = r["kind"]
-            sched = r.get("schedule_json") or {}
-            if isinstance(sched, dict):
-                for d, arr in sched.items():
-                    if not isinstance(arr, list):
-                        continue
-                    for t in arr:
-                        if isinstance(t, str) and len(t) == 5 and t[2] == ":":
-                            conn.execute(text("""
-                                INSERT INTO reservation_slots(kind, day, time, submission_id)
-                                VALUES (:k, :d, :t, :sid)
-                                ON CONFLICT (kind, day, time) DO NOTHING
-                            """), {"k": k, "d": d, "t": t, "sid": sid})
+        conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_reservation_slots_submission
+          ON reservation_slots(submission_id);
+        """))
+
+        # 既存 submissions の schedule_json からのバックフィルは移行として 1 回だけ流す。
+        # 以降は reservation_slots が正（消した枠を再起動で戻さない・毎回全 JSON を走査しない）。
+        # 複数ワーカー同時起動でも印を入れられた 1 本だけが実行する
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+          name TEXT PRIMARY KEY,
+          applied_at TIMESTAMPTZ DEFAULT now()
+        );
+        """))
+        if conn.execute(text("""
+            INSERT INTO schema_migrations(name) VALUES ('backfill_reservation_slots')
+            ON CONFLICT DO NOTHING
+            RETURNING name
+        """)).first():
+            conn.execute(text(BACKFILL_SLOTS_SQL))
+
+        # ★ スケジュールの正は reservation_slots。{"YYYY-MM-DD": ["HH:MM", ...]} 形式はビューで再構成する
+        conn.execute(text(SUBMISSION_SCHEDULES_VIEW_SQL))
+
+        # schedule_json は互換のため残すだけで検索には使わない（recurrence 申請は {} を保存する）。
+        # 日付・時刻での検索は reservation_slots の PK (kind, day, time) で引く
+
+        # ★ 予約/解放の通知（文単位トリガー。kind×day×時 ごとに times をまとめて NOTIFY）
+        #    INSERT と DELETE で遷移テーブル名を揃え、関数は共通にする
+        conn.execute(text("""
+        CREATE OR REPLACE FUNCTION notify_slot_changes() RETURNS trigger AS $$
+        DECLARE
+          r RECORD;
+          ev TEXT := CASE WHEN TG_OP = 'INSERT' THEN 'booked' ELSE 'released' END;
+        BEGIN
+          FOR r IN
+            SELECT kind, day, date_part('hour', time) AS h,
+                   json_agg(to_char(time, 'HH24:MI') ORDER BY time) AS times
+              FROM changed_rows
+             GROUP BY kind, day, date_part('hour', time)
+          LOOP
+            PERFORM pg_notify('slot_changes', json_build_object(
+              'event', ev, 'kind', r.kind, 'day', r.day::text, 'times', r.times
+            )::text);
+          END LOOP;
+          RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        """))
+        conn.execute(text("""
+        CREATE OR REPLACE TRIGGER trg_reservation_slots_notify_ins
+          AFTER INSERT ON reservation_slots
+          REFERENCING NEW TABLE AS changed_rows
+          FOR EACH STATEMENT EXECUTE FUNCTION notify_slot_changes();
+        """))
+        conn.execute(text("""
+        CREATE OR REPLACE TRIGGER trg_reservation_slots_notify_del
+          AFTER DELETE ON reservation_slots
+          REFERENCING OLD TABLE AS changed_rows
+          FOR EACH STATEMENT EXECUTE FUNCTION notify_slot_changes();
+        """))
+
+        init_stats_schema(conn)
+
+        # ★ 再生マニフェスト（kind×day ごとの版付き JSON。版は不変）
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS playback_manifests (
+          kind     VARCHAR(20) NOT NULL,
+          day      DATE NOT NULL,
+          version  INTEGER NOT NULL,
+          etag     TEXT NOT NULL,
+          body     TEXT NOT NULL,
+          built_at TIMESTAMPTZ DEFAULT now(),
+          PRIMARY KEY (kind, day, version)
+        );
+        """))
+
+def init_stats_schema(conn):
+    """
+    集計用ロールアップ
+      stats_slots_hourly   : kind×day×hour の予約スロット数
+      stats_decisions_daily: kind×会社×day×status の件数（submitted / approved / rejected）
+    トリガーは追記専用の stats_*_delta に差分を積むだけ（共有行をロックしない）。
+    申請の INSERT はアップロード完了までトランザクションが続くため、ロールアップ行を
+    直接更新すると同じ時間帯の別予約がその間待たされる。差分は stats_fold() が定期的に畳み込み、
+    集計 API はロールアップ＋未畳み込みの差分を合算して読む。
+    """
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS stats_slots_hourly (
+      kind   VARCHAR(20) NOT NULL,
+      day    DATE NOT NULL,
+      hour   SMALLINT NOT NULL,
+      booked INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (kind, day, hour)
+    );
+    """))
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS stats_decisions_daily (
+      kind         VARCHAR(20) NOT NULL,
+      company_name TEXT NOT NULL,
+      day          DATE NOT NULL,
+      status       TEXT NOT NULL,
+      n            INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (kind, company_name, day, status)
+    );
+    """))
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_stats_decisions_daily_day
+      ON stats_decisions_daily(day);
+    """))
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS stats_slots_delta (
+      id     BIGSERIAL PRIMARY KEY,
+      kind   VARCHAR(20) NOT NULL,
+      day    DATE NOT NULL,
+      hour   SMALLINT NOT NULL,
+      booked INTEGER NOT NULL
+    );
+    """))
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS stats_decisions_delta (
+      id           BIGSERIAL PRIMARY KEY,
+      kind         VARCHAR(20) NOT NULL,
+      company_name TEXT NOT NULL,
+      day          DATE NOT NULL,
+      status       TEXT NOT NULL,
+      n            INTEGER NOT NULL
+    );
+    """))
+
+    # スロット: 文単位で kind×day×hour ごとの差分を追記
+    conn.execute(text("""
+    CREATE OR REPLACE FUNCTION stats_slots_apply() RETURNS trigger AS $$
+    DECLARE
+      sign INTEGER := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    BEGIN
+      INSERT INTO stats_slots_delta(kind, day, hour, booked)
+      SELECT kind, day, date_part('hour', time)::smallint, sign * count(*)
+        FROM changed_rows
+       GROUP BY 1, 2, 3;
+      RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    """))
+    conn.execute(text("""
+    CREATE OR REPLACE TRIGGER trg_reservation_slots_stats_ins
+      AFTER INSERT ON reservation_slots
+      REFERENCING NEW TABLE AS changed_rows
+      FOR EACH STATEMENT EXECUTE FUNCTION stats_slots_apply();
+    """))
+    conn.execute(text("""
+    CREATE OR REPLACE TRIGGER trg_reservation_slots_stats_del
+      AFTER DELETE ON reservation_slots
+      REFERENCING OLD TABLE AS changed_rows
+      FOR EACH STATEMENT EXECUTE FUNCTION stats_slots_apply();
+    """))
+
+    # 申請/審査: INSERT で submitted、status・decided_at の変化で旧バケット減・新バケット増
+    conn.execute(text("""
+    CREATE OR REPLACE FUNCTION stats_decisions_apply() RETURNS trigger AS $$
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        INSERT INTO stats_decisions_delta(kind, company_name, day, status, n)
+        VALUES (NEW.kind, NEW.company_name, COALESCE(NEW.created_at, now())::date, 'submitted', 1);
+        RETURN NULL;
+      END IF;
+
+      IF OLD.status IN ('approved', 'rejected') THEN
+        INSERT INTO stats_decisions_delta(kind, company_name, day, status, n)
+        VALUES (OLD.kind, OLD.company_name, COALESCE(OLD.decided_at, OLD.created_at)::date, OLD.status, -1);
+      END IF;
+      IF NEW.status IN ('approved', 'rejected') THEN
+        INSERT INTO stats_decisions_delta(kind, company_name, day, status, n)
+        VALUES (NEW.kind, NEW.company_name, COALESCE(NEW.decided_at, now())::date, NEW.status, 1);
+      END IF;
+      RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    """))
+    conn.execute(text("""
+    CREATE OR REPLACE TRIGGER trg_submissions_stats_ins
+      AFTER INSERT ON submissions
+      FOR EACH ROW EXECUTE FUNCTION stats_decisions_apply();
+    """))
+    conn.execute(text("""
+    CREATE OR REPLACE TRIGGER trg_submissions_stats_upd
+      AFTER UPDATE OF status, decided_at ON submissions
+      FOR EACH ROW
+      WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.decided_at IS DISTINCT FROM NEW.decided_at)
+      EXECUTE FUNCTION stats_decisions_apply();
+    """))
+
+    # 差分の畳み込み。DELETE ... RETURNING はコミット済みの差分だけを拾うので、
+    # 実行中の申請トランザクションの分は次回に回る（ORDER BY で行ロック順を固定）
+    conn.execute(text("""
+    CREATE OR REPLACE FUNCTION stats_fold() RETURNS void AS $$
+    BEGIN
+      IF NOT pg_try_advisory_xact_lock(hashtext('stats_fold')) THEN
+        RETURN;
+      END IF;
+
+      WITH d AS (DELETE FROM stats_slots_delta RETURNING kind, day, hour, booked)
+      INSERT INTO stats_slots_hourly(kind, day, hour, booked)
+      SELECT kind, day, hour, sum(booked)
+        FROM d
+       GROUP BY 1, 2, 3
+       ORDER BY 1, 2, 3
+      ON CONFLICT (kind, day, hour)
+      DO UPDATE SET booked = stats_slots_hourly.booked + EXCLUDED.booked;
+
+      WITH d AS (DELETE FROM stats_decisions_delta RETURNING kind, company_name, day, status, n)
+      INSERT INTO stats_decisions_daily(kind, company_name, day, status, n)
+      SELECT kind, company_name, day, status, sum(n)
+        FROM d
+       GROUP BY 1, 2, 3, 4
+       ORDER BY 1, 2, 3, 4
+      ON CONFLICT (kind, company_name, day, status)
+      DO UPDATE SET n = stats_decisions_daily.n + EXCLUDED.n;
+    END $$ LANGUAGE plpgsql;
+    """))
+
+    # 初回のみ既存データから構築（複数ワーカー同時起動でも ON CONFLICT で二重計上しない）
+    conn.execute(text("""
+    INSERT INTO stats_slots_hourly(kind, day, hour, booked)
+    SELECT kind, day, date_part('hour', time)::smallint, count(*)
+      FROM reservation_slots
+     WHERE NOT EXISTS (SELECT 1 FROM stats_slots_hourly)
+       AND NOT EXISTS (SELECT 1 FROM stats_slots_delta)
+     GROUP BY 1, 2, 3
+    ON CONFLICT DO NOTHING;
+    """))
+    conn.execute(text("""
+    INSERT INTO stats_decisions_daily(kind, company_name, day, status, n)
+    SELECT kind, company_name, day, status, count(*)
+      FROM (
+        SELECT kind, company_name, COALESCE(created_at, now())::date AS day, 'submitted' AS status
+          FROM submissions
+        UNION ALL
+        SELECT kind, company_name, COALESCE(decided_at, created_at, now())::date, status
+          FROM submissions
+         WHERE status IN ('approved', 'rejected')
+      ) x
+     WHERE NOT EXISTS (SELECT 1 FROM stats_decisions_daily)
+       AND NOT EXISTS (SELECT 1 FROM stats_decisions_delta)
+     GROUP BY 1, 2, 3, 4
+    ON CONFLICT DO NOTHING;
+    """))
 
 def init_admin_auth_db_with_retry():
     # 管理認証DB待機
@@ -318,6 +1171,29 @@ def on_startup():
     init_app_db_with_retry()
     init_admin_auth_db_with_retry()
 
+# ★ LISTEN 用スレッドはイベントループ確定後に起動
+@app.on_event("startup")
+async def start_notify_hub():
+    notify_hub.start(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+def stop_notify_hub():
+    notify_hub.stop()
+
+@app.on_event("startup")
+def start_audio_jobs():
+    requeue_audio_jobs()
+
+@app.on_event("startup")
+def start_stats_fold():
+    if STATS_FOLD_INTERVAL_SECONDS > 0:
+        threading.Thread(target=_stats_fold_loop, name="stats-fold", daemon=True).start()
+
+@app.on_event("startup")
+def start_storage_gc():
+    if STORAGE_GC_INTERVAL_SECONDS > 0:
+        threading.Thread(target=_storage_gc_loop, name="storage-gc", daemon=True).start()
+
 # ---- ミドルウェア ----
 app.add_middleware(
     CORSMiddleware,
@@ -353,8 +1229,8 @@ def health():
 # ---- FirstChoice（既存）----
 @app.get("/api/FirstChoice")
 def list_posts():
-    with engine.begin() as conn:
-        rows = conn.execute(text("SELECT id, kind, title FROM posts ORDER BY id DESC")).mappings().all()
+    rows = read_with_fallback(
+        lambda conn: conn.execute(text("SELECT id, kind, title FROM posts ORDER BY id DESC")).mappings().all())
     return {"items": [dict(r) for r in rows]}
 
 @app.post("/api/FirstChoice")
@@ -544,79 +1420,274 @@ def _valid_sched_dict(sched) -> bool:
         for t in arr:
             if not (isinstance(t, str) and len(t) == 5 and t[2] == ":"):
                 return False
+            # 衝突判定は (kind, day, time) の一致なので、枠の区切りに揃っていない時刻は受け付けない
+            try:
+                if _hhmm_to_min(t) % SLOT_MINUTES or _hhmm_to_min(t) >= 24 * 60:
+                    return False
+            except ValueError:
+                return False
     return True
 
-def find_conflicts(conn, kind: str, sched: dict) -> List[Tuple[str, str]]:
-    conflicts: List[Tuple[str, str]] = []
-    if not isinstance(sched, dict):
-        return conflicts
-    for day, times in sched.items():
+def _hhmm_to_min(v) -> int:
+    if not (isinstance(v, str) and len(v) == 5 and v[2] == ":"):
+        raise ValueError(f"invalid time: {v}")
+    h, m = int(v[:2]), int(v[3:])
+    if not (0 <= m < 60 and 0 <= h * 60 + m <= 24 * 60):
+        raise ValueError(f"invalid time: {v}")
+    return h * 60 + m
+
+def _parse_recurrence(rule) -> Dict:
+    """
+    繰り返し指定を検証して正規化する（不正なら ValueError）
+      {"start": "YYYY-MM-DD", "end": "YYYY-MM-DD",        # 両端含む
+       "weekdays": [0..6],                                 # 月=0（省略時は毎日）
+       "windows": [["08:00", "20:00"], ...],               # [from, to) ※ {"from","to"} も可
+       "interval": 60}                                     # 開始時刻の間隔・分（省略時 SLOT_MINUTES）
+    1 回の予約は常に SLOT_MINUTES 分の 1 枠。衝突は reservation_slots の PK (kind, day, time) で
+    判定するため、interval と窓の両端は SLOT_MINUTES の倍数に揃っている必要がある。
+    """
+    if not isinstance(rule, dict):
+        raise ValueError("recurrence must be object")
+    s = datetime.strptime(rule["start"], "%Y-%m-%d").date()
+    e = datetime.strptime(rule["end"], "%Y-%m-%d").date()
+    if e < s or (e - s).days + 1 > RECURRENCE_MAX_DAYS:
+        raise ValueError("invalid date range")
+
+    weekdays = rule.get("weekdays")
+    if weekdays is None:
+        weekdays = list(range(7))
+    if not (isinstance(weekdays, list) and weekdays
+            and all(isinstance(w, int) and not isinstance(w, bool) and 0 <= w <= 6 for w in weekdays)):
+        raise ValueError("invalid weekdays")
+
+    interval = rule.get("interval", SLOT_MINUTES)
+    # bool は int のサブクラスなので明示的に弾く
+    if not (isinstance(interval, int) and not isinstance(interval, bool)
+            and SLOT_MINUTES <= interval <= 24 * 60 and interval % SLOT_MINUTES == 0):
+        raise ValueError(f"interval must be a multiple of {SLOT_MINUTES}")
+
+    windows = []
+    for w in rule.get("windows") or []:
+        frm, to = (w.get("from"), w.get("to")) if isinstance(w, dict) else (w[0], w[1])
+        a, b = _hhmm_to_min(frm), _hhmm_to_min(to)
+        if b <= a:
+            raise ValueError("invalid window")
+        if a % SLOT_MINUTES or b % SLOT_MINUTES:
+            raise ValueError(f"window must be aligned to {SLOT_MINUTES} minutes")
+        windows.append([frm, to])
+    if not windows:
+        raise ValueError("windows is required")
+
+    return {
+        "start": s.isoformat(),
+        "end": e.isoformat(),
+        "weekdays": sorted(set(weekdays)),
+        "windows": windows,
+        "interval": interval,
+    }
+
+def _iter_recurrence(rule: Dict) -> Iterator[Tuple[str, str]]:
+    """正規化済みルールを (YYYY-MM-DD, HH:MM) に遅延展開する"""
+    s = datetime.strptime(rule["start"], "%Y-%m-%d").date()
+    e = datetime.strptime(rule["end"], "%Y-%m-%d").date()
+    weekdays = set(rule["weekdays"])
+    # 1 日分の時刻列は全日で同じなので先に作る（窓の重なりは除く）
+    minutes = sorted({
+        m
+        for frm, to in rule["windows"]
+        for m in range(_hhmm_to_min(frm), _hhmm_to_min(to), rule["interval"])
+        if m < 24 * 60
+    })
+    times = [f"{m // 60:02d}:{m % 60:02d}" for m in minutes]
+    d = s
+    while d <= e:
+        if d.weekday() in weekdays:
+            ds = d.isoformat()
+            for t in times:
+                yield ds, t
+        d += timedelta(days=1)
+
+def _iter_sched_slots(sched: dict) -> Iterator[Tuple[str, str]]:
+    """{"YYYY-MM-DD": ["HH:MM", ...]} を (day, time) に展開する"""
+    for day, times in (sched or {}).items():
         if not isinstance(times, list):
             continue
         for tm in times:
-            if not (isinstance(tm, str) and len(tm) == 5 and tm[2] == ":"):
-                continue
-            row = conn.execute(
-                text("SELECT 1 FROM reservation_slots WHERE kind=:k AND day=:d AND time=:t LIMIT 1"),
-                {"k": kind, "d": day, "t": tm}
-            ).first()
-            if row:
-                conflicts.append((day, tm))
+            if isinstance(tm, str) and len(tm) == 5 and tm[2] == ":":
+                yield day, tm
+
+def _iter_slots(sched: Optional[dict], rule: Optional[Dict]) -> Iterator[Tuple[str, str]]:
+    return _iter_recurrence(rule) if rule is not None else _iter_sched_slots(sched)
+
+def _parse_schedule_input(schedule: Optional[str], recurrence: Optional[str]) -> Tuple[Optional[dict], Optional[Dict]]:
+    """schedule（日付→時刻の明示マップ）か recurrence（繰り返し指定）のどちらか一方を受け付ける"""
+    if bool(schedule) == bool(recurrence):
+        raise HTTPException(status_code=400, detail="either schedule or recurrence is required")
+    if recurrence:
+        try:
+            return None, _parse_recurrence(json.loads(recurrence))
+        except Exception:
+            raise HTTPException(status_code=400, detail="invalid recurrence JSON")
+    try:
+        sched = json.loads(schedule)
+        if not _valid_sched_dict(sched):
+            raise ValueError("schedule must be object")
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid schedule JSON")
+    return sched, None
+
+def _chunked_slots(slots: Iterable[Tuple[str, str]]) -> Iterator[Tuple[List[str], List[str]]]:
+    days: List[str] = []
+    times: List[str] = []
+    for d, t in slots:
+        days.append(d)
+        times.append(t)
+        if len(days) >= SLOT_CHUNK_SIZE:
+            yield days, times
+            days, times = [], []
+    if days:
+        yield days, times
+
+def find_conflicts(conn, kind: str, slots: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    conflicts: List[Tuple[str, str]] = []
+    for days, times in _chunked_slots(slots):
+        rows = conn.execute(text("""
+            SELECT rs.day::text AS d, to_char(rs.time, 'HH24:MI') AS t
+              FROM unnest(CAST(:days AS date[]), CAST(:times AS time[])) AS x(day, time)
+              JOIN reservation_slots rs
+                ON rs.kind = :k AND rs.day = x.day AND rs.time = x.time
+             ORDER BY 1, 2
+        """), {"k": kind, "days": days, "times": times}).all()
+        conflicts.extend((r[0], r[1]) for r in rows)
     return conflicts
 
-def _insert_slots(conn, kind: str, submission_id: int, sched: dict):
+def _insert_slots(conn, kind: str, submission_id: int, slots: Iterable[Tuple[str, str]]):
     try:
-        for day, times in (sched or {}).items():
-            if not isinstance(times, list):
-                continue
-            for tm in times:
-                if isinstance(tm, str) and len(tm) == 5 and tm[2] == ":":
-                    conn.execute(text("""
-                        INSERT INTO reservation_slots(kind, day, time, submission_id)
-                        VALUES (:k, :d, :t, :sid)
-                    """), {"k": kind, "d": day, "t": tm, "sid": int(submission_id)})
+        for days, times in _chunked_slots(slots):
+            conn.execute(text("""
+                INSERT INTO reservation_slots(kind, day, time, submission_id)
+                SELECT :k, x.day, x.time, :sid
+                  FROM unnest(CAST(:days AS date[]), CAST(:times AS time[])) AS x(day, time)
+            """), {"k": kind, "sid": int(submission_id), "days": days, "times": times})
     except IntegrityError:
         raise HTTPException(status_code=409, detail={"message": "slot conflicts"})
 
+def _schedule_summary(sched: Optional[dict], rule: Optional[Dict]) -> str:
+    """申請受付メール用の日程サマリ"""
+    def _fmt_day(d: str) -> str:
+        dt = datetime.strptime(d, "%Y-%m-%d").date()
+        return f"{dt.month}/{dt.day}"
+    if rule is not None:
+        wd = "".join("月火水木金土日"[w] for w in rule["weekdays"])
+        wins = ", ".join(f"{a}〜{b}" for a, b in rule["windows"])
+        return (f"{_fmt_day(rule['start'])}〜{_fmt_day(rule['end'])}（{wd}） {wins} "
+                f"{rule['interval']}分毎に{SLOT_MINUTES}分")
+    parts = []
+    for d, arr in sched.items():
+        if isinstance(arr, list) and arr:
+            parts.append(f"{_fmt_day(d)} " + ", ".join(arr))
+    return "\n".join(parts) if parts else "-"
+
+def _parse_file_keys(file_keys: Optional[str]) -> List[Dict]:
+    """
+    直接アップロード済みオブジェクトの指定を検証する
+      ["<key>", ...] または [{"key", "name", "contentType"}, ...]
+    """
+    if not file_keys:
+        return []
+    try:
+        items = json.loads(file_keys)
+        if not isinstance(items, list):
+            raise ValueError("file_keys must be array")
+        out = []
+        seen = set()
+        for it in items:
+            if isinstance(it, str):
+                it = {"key": it}
+            key = it["key"]
+            if not (isinstance(key, str) and _UPLOAD_KEY_RE.match(key)):
+                raise ValueError(f"invalid key: {key}")
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append({"key": key, "name": str(it.get("name") or key), "mime": str(it.get("contentType") or "")})
+        return out
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid file_keys")
+
 # 共通: 複数 UploadFile を保存して submission_files に登録
-async def _save_files_for_submission(conn, submission_id: int, files: Optional[List[UploadFile]]) -> List[str]:
-    saved_paths: List[str] = []
-    if not files:
-        return saved_paths
-    for f in files:
+#   メタデータを先に集め、multi-VALUES の INSERT 1 回で登録する（RETURNING id, path）
+#   keys: 直接アップロード済みのオブジェクト（_parse_file_keys の結果）。存在とサイズだけ確認する
+async def _save_files_for_submission(
+    conn, submission_id: int, files: Optional[List[UploadFile]], keys: Optional[List[Dict]] = None,
+) -> List[Dict]:
+    metas: List[Dict] = []
+    for f in files or []:
         if not f:
             continue
-        ext = (Path(f.filename).suffix or "").lower()
-        unique_name = f"{uuid.uuid4().hex}{ext}"
-        dest = UPLOAD_DIR / unique_name
-        data = await f.read()
-        dest.write_bytes(data)
-        size = dest.stat().st_size
-        conn.execute(
-            text("""
-                INSERT INTO submission_files(submission_id, path, original_name, mime, size)
-                VALUES (:sid, :p, :o, :m, :sz)
-            """),
-            {
-                "sid": submission_id,
-                "p": str(dest),
-                "o": f.filename or unique_name,
-                "m": f.content_type or "",
-                "sz": size,
-            },
-        )
-        saved_paths.append(str(dest))
-    return saved_paths
+        key = new_upload_key(f.filename)
+        path, size = storage.save(key, f.file, f.content_type or "")
+        metas.append({
+            "p": path,
+            "o": f.filename or key,
+            "m": f.content_type or "",
+            "sz": size,
+            "ms": "pending" if _is_audio(f.content_type, f.filename) else None,
+        })
+    if keys:
+        # 登録済みのオブジェクトは動かさない（公開 URL やマニフェストから key は見える）
+        taken = conn.execute(text(f"""
+            SELECT {_storage_key_sql("path")} FROM submission_files
+             WHERE {_storage_key_sql("path")} = ANY(:keys)
+             LIMIT 1
+        """), {"keys": [k["key"] for k in keys]}).scalar()
+        if taken is not None:
+            raise HTTPException(status_code=400, detail={"message": "uploaded object not found", "key": taken})
+    for k in keys or []:
+        claimed = storage.claim(k["key"])
+        if claimed is None:
+            raise HTTPException(status_code=400, detail={"message": "uploaded object not found", "key": k["key"]})
+        path, size = claimed
+        metas.append({
+            "p": path,
+            "o": k["name"],
+            "m": k["mime"],
+            "sz": size,
+            "ms": "pending" if _is_audio(k["mime"], k["name"]) else None,
+        })
+    if not metas:
+        return []
+
+    values_sql = []
+    params: Dict = {"sid": submission_id}
+    for i, m in enumerate(metas):
+        values_sql.append(f"(:sid, :p{i}, :o{i}, :m{i}, :sz{i}, :ms{i})")
+        for k, v in m.items():
+            params[f"{k}{i}"] = v
+    rows = conn.execute(
+        text(f"""
+            INSERT INTO submission_files(submission_id, path, original_name, mime, size, media_status)
+            VALUES {", ".join(values_sql)}
+            RETURNING id, path
+        """),
+        params,
+    ).all()
+
+    # RETURNING の順序は保証されないので path で対応付けて入力順に並べる
+    id_by_path = {r[1]: int(r[0]) for r in rows}
+    return [{"id": id_by_path[m["p"]], "path": m["p"], "audio": m["ms"] is not None} for m in metas]
 
 # --- trucks ---
 @app.post("/api/trucks")
 async def create_trucks(
     kind: str = Form(...),
     title: str = Form(""),
-    schedule: str = Form(...),
-    files_trucks: List[UploadFile] = File(...),
+    schedule: Optional[str] = Form(None),                    # {"YYYY-MM-DD":["HH:MM",...]}
+    recurrence: Optional[str] = Form(None),                  # 繰り返し指定（schedule の代わり）
+    files_trucks: Optional[List[UploadFile]] = File(None),
     files_truck: Optional[List[UploadFile]] = File(None),   # 互換：旧名でも受ける
     audio: UploadFile | None = File(None),
+    file_keys: Optional[str] = Form(None),                   # 直接アップロード済みのキー(JSON配列)
     message: Optional[str] = Form(None),
     caption: Optional[str] = Form(None),
     text_color: Optional[str] = Form(None),
@@ -626,7 +1697,14 @@ async def create_trucks(
     overlay: Optional[str] = Form(None),                     # プレビュー設定(JSON文字列)
     company_name: str = Form(""),
     authorization: Optional[str] = Header(None),
+    response: Response = None,
 ):
+    # ファイル名の揺れを吸収
+    incoming_files = files_trucks or files_truck or []
+    keys = _parse_file_keys(file_keys)
+    if not (incoming_files or keys):
+        raise HTTPException(status_code=400, detail="no files selected")
+
     # 正規化
     lines_list: Optional[List[str]] = None
     if not lines and words:
@@ -650,12 +1728,10 @@ async def create_trucks(
             overlay_obj = None
 
     # スケジュール検証 & 競合
+    sched, rule = _parse_schedule_input(schedule, recurrence)
     try:
-        sched = json.loads(schedule)
-        if not _valid_sched_dict(sched):
-            raise ValueError("schedule must be object")
         with engine.begin() as conn:
-            conflicts = find_conflicts(conn, kind, sched)
+            conflicts = find_conflicts(conn, kind, _iter_slots(sched, rule))
             if conflicts:
                 raise HTTPException(
                     status_code=409,
@@ -666,22 +1742,23 @@ async def create_trucks(
     except Exception:
         raise HTTPException(status_code=400, detail="invalid schedule JSON")
 
-    saved_paths: List[str] = []
+    saved: List[Dict] = []
     with engine.begin() as conn:
         sub_id = conn.execute(
             text("""
                 INSERT INTO submissions(
-                    kind, title, schedule_json,
+                    kind, title, schedule_json, schedule_rule,
                     company_name, message, caption, text_color, lines, overlay
                 )
-                VALUES (:k, :t, CAST(:s AS JSONB),
+                VALUES (:k, :t, CAST(:s AS JSONB), CAST(:rule AS JSONB),
                         :company, :msg, :cap, :color, CAST(:lines AS JSONB), CAST(:overlay AS JSONB))
                 RETURNING id
             """),
             {
                 "k": kind,
                 "t": title,
-                "s": json.dumps(sched),
+                "s": json.dumps(sched if sched is not None else {}),
+                "rule": json.dumps(rule) if rule is not None else None,
                 "company": company_name,
                 "msg": message,
                 "cap": caption,
@@ -691,30 +1768,25 @@ async def create_trucks(
             },
         ).scalar_one()
 
-        _insert_slots(conn, kind, sub_id, sched)
+        _insert_slots(conn, kind, sub_id, _iter_slots(sched, rule))
+        _notify_submission(conn, sub_id, "created")
 
-        # ファイル名の揺れを吸収
-        incoming_files = files_trucks or files_truck or []
-        saved_paths = await _save_files_for_submission(conn, sub_id, incoming_files)
+        # 音声・直接アップロード分も同じ INSERT でまとめて登録
+        saved = await _save_files_for_submission(
+            conn, sub_id, list(incoming_files) + ([audio] if audio else []), keys
+        )
 
-        # 音声も保存（あれば）
-        if audio:
-            saved_paths += await _save_files_for_submission(conn, sub_id, [audio])
+    remember_write(response, engine, LSN_COOKIE)
+    enqueue_audio_jobs([x["id"] for x in saved if x["audio"]])
+    prewarm_render(sub_id)
 
     # 申請受付メール（任意）
     user = try_get_user_from_auth(authorization)
     if user and user.get("email"):
-        images_cnt = len(incoming_files)
-        audio_txt = "あり" if audio else "なし"
+        images_cnt = len(incoming_files) + sum(1 for k in keys if not k["mime"].startswith("audio/"))
+        audio_txt = "あり" if audio or any(k["mime"].startswith("audio/") for k in keys) else "なし"
         try:
-            def _fmt_day(d: str) -> str:
-                dt = datetime.strptime(d, "%Y-%m-%d").date()
-                return f"{dt.month}/{dt.day}"
-            parts = []
-            for d, arr in sched.items():
-                if isinstance(arr, list) and arr:
-                    parts.append(f"{_fmt_day(d)} " + ", ".join(arr))
-            sched_summary = "\n".join(parts) if parts else "-"
+            sched_summary = _schedule_summary(sched, rule)
         except Exception:
             sched_summary = "-"
         subject = "【申請完了】アドトラックの申請を受け付けました"
@@ -732,14 +1804,22 @@ async def create_trucks(
         except Exception:
             pass
 
-    return {"ok": True, "submission_id": sub_id, "files": saved_paths}
+    return {
+        "ok": True,
+        "submission_id": sub_id,
+        "files": [x["path"] for x in saved],
+        "file_ids": [x["id"] for x in saved],
+        "media_token": _media_token(sub_id),
+    }
 
 # --- Bulk（最小修正＋文言/overlay対応） ---
 @app.post("/api/submit/bulk")
 async def create_bulk(
     title: str = Form(""),
-    schedule: str = Form(...),                        # {"YYYY-MM-DD":["HH:MM",...]}
+    schedule: Optional[str] = Form(None),             # {"YYYY-MM-DD":["HH:MM",...]}
+    recurrence: Optional[str] = Form(None),           # 繰り返し指定（schedule の代わり）
     files_truck: Optional[List[UploadFile]] = File(None),
+    file_keys: Optional[str] = Form(None),            # 直接アップロード済みのキー(JSON配列)
 
     # 文言・スタイル・別名・overlay
     message: Optional[str] = Form(None),
@@ -750,16 +1830,13 @@ async def create_bulk(
     words: Optional[str] = Form(None),
     overlay: Optional[str] = Form(None),
     company_name: str = Form(""),
+    response: Response = None,
 ):
     # スケジュール検証
-    try:
-        sched = json.loads(schedule)
-        if not _valid_sched_dict(sched):
-            raise ValueError("schedule must be object")
-    except Exception:
-        raise HTTPException(status_code=400, detail="invalid schedule JSON")
+    sched, rule = _parse_schedule_input(schedule, recurrence)
 
-    if not (files_truck and len(files_truck) > 0):
+    keys = _parse_file_keys(file_keys)
+    if not ((files_truck and len(files_truck) > 0) or keys):
         raise HTTPException(status_code=400, detail="no files selected")
 
     # 文言正規化
@@ -784,23 +1861,24 @@ async def create_bulk(
         except Exception:
             overlay_obj = None
 
-    result = {"truck": {"submission_id": None, "files": []}}
+    result = {"truck": {"submission_id": None, "files": [], "file_ids": [], "media_token": None}}
 
     with engine.begin() as conn:
         truck_id = conn.execute(
             text("""
                 INSERT INTO submissions(
-                    kind, title, schedule_json,
+                    kind, title, schedule_json, schedule_rule,
                     company_name, message, caption, text_color, lines, overlay
                 )
-                VALUES (:k, :t, CAST(:s AS JSONB),
+                VALUES (:k, :t, CAST(:s AS JSONB), CAST(:rule AS JSONB),
                         :company, :msg, :cap, :color, CAST(:lines AS JSONB), CAST(:overlay AS JSONB))
                 RETURNING id
             """),
             {
                 "k": "アドトラック",
                 "t": title,
-                "s": json.dumps(sched),
+                "s": json.dumps(sched if sched is not None else {}),
+                "rule": json.dumps(rule) if rule is not None else None,
                 "company": company_name,
                 "msg": message,
                 "cap": caption,
@@ -810,11 +1888,17 @@ async def create_bulk(
             },
         ).scalar_one()
 
-        _insert_slots(conn, "アドトラック", truck_id, sched)
-        files = await _save_files_for_submission(conn, truck_id, files_truck)
+        _insert_slots(conn, "アドトラック", truck_id, _iter_slots(sched, rule))
+        _notify_submission(conn, truck_id, "created")
+        files = await _save_files_for_submission(conn, truck_id, files_truck, keys)
         result["truck"]["submission_id"] = int(truck_id)
-        result["truck"]["files"] = files
+        result["truck"]["files"] = [x["path"] for x in files]
+        result["truck"]["file_ids"] = [x["id"] for x in files]
+        result["truck"]["media_token"] = _media_token(truck_id)
 
+    remember_write(response, engine, LSN_COOKIE)
+    enqueue_audio_jobs([x["id"] for x in files if x["audio"]])
+    prewarm_render(truck_id)
     return {"ok": True, "result": result}
 
 # =============================
@@ -828,6 +1912,7 @@ def _parse_date(date_str: str) -> datetime.date:
 
 @app.get("/api/truck/booked")
 def get_booked_slots_truck(
+    request: Request,
     start: str = Query(..., description="YYYY-MM-DD（含む）"),
     end: str   = Query(..., description="YYYY-MM-DD（含む）"),
     kind: str  = Query(..., description="対象kind（アドトラック)"),
@@ -841,20 +1926,128 @@ def get_booked_slots_truck(
     if not k:
         raise HTTPException(status_code=422, detail="kind is required")
 
-    with engine.begin() as conn:
-        rows = conn.execute(text("""
-            SELECT day::text AS d, to_char(time, 'HH24:MI') AS t
-              FROM reservation_slots
-             WHERE day BETWEEN :s AND :e
-               AND kind = :k
-             ORDER BY d, t
-        """), {"s": s, "e": e, "k": k}).mappings().all()
+    sql = text("""
+        SELECT day::text AS d, to_char(time, 'HH24:MI') AS t
+          FROM reservation_slots
+         WHERE day BETWEEN :s AND :e
+           AND kind = :k
+         ORDER BY d, t
+    """)
+    rows = read_with_fallback(
+        lambda conn: conn.execute(sql, {"s": s, "e": e, "k": k}).mappings().all(),
+        min_lsn=_min_lsn(request, LSN_COOKIE))
 
     out: Dict[str, List[str]] = {}
     for r in rows:
         out.setdefault(r["d"], []).append(r["t"])
     return out
 
+def _parse_hhmm(v: str) -> int:
+    """HH:MM → 0 時からの分"""
+    try:
+        t = datetime.strptime(v, "%H:%M")
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"invalid time format: {v} (HH:MM expected)")
+    return t.hour * 60 + t.minute
+
+# =============================
+# 空き枠検索: 期間 × 時間帯の候補を DB 側で生成し、reservation_slots と突き合わせる
+#   step 分の枠は、その中の SLOT_MINUTES 刻みがすべて空いているときだけ空きとみなす。
+#   候補は日付→時刻順に並べ、最初の limit 件で打ち切る（PK (kind, day, time) の範囲探索のみ）。
+# =============================
+# 実行計画と 1 年分の密な予約での所要時間は scripts/bench_available_slots.py で確認する
+_AVAILABLE_SLOTS_SQL = """
+    SELECT c.day::text AS d, to_char(c.t, 'HH24:MI') AS t
+      FROM (
+        SELECT g.day::date AS day,
+               (TIME '00:00' + make_interval(mins => :m_from + i * :step)) AS t
+          FROM generate_series(CAST(:s AS date), CAST(:e AS date), INTERVAL '1 day') AS g(day)
+         CROSS JOIN generate_series(0, :n - 1) AS i
+      ) c
+     WHERE NOT EXISTS (
+             SELECT 1
+               FROM reservation_slots r
+              WHERE r.kind = :k
+                AND r.day = c.day
+                AND r.time >= c.t
+                AND r.time < c.t + make_interval(mins => :step)
+           )
+     ORDER BY c.day, c.t
+     LIMIT :lim
+"""
+
+@app.get("/api/truck/available")
+def get_available_slots_truck(
+    request: Request,
+    kind: str  = Query(..., description="対象kind（アドトラック)"),
+    start: str = Query(..., description="YYYY-MM-DD（含む）"),
+    end: str   = Query(..., description="YYYY-MM-DD（含む）"),
+    time_from: Optional[str] = Query(None, alias="from", description="HH:MM 枠の開始（既定: 営業開始）"),
+    time_to: Optional[str]   = Query(None, alias="to", description="HH:MM 枠の終了（既定: 営業終了）"),
+    step: int  = Query(SLOT_MINUTES, ge=SLOT_MINUTES, le=24 * 60, description="枠の長さ（分・SLOT_MINUTES の倍数）"),
+    limit: int = Query(30, ge=1, le=1000),
+):
+    s = _parse_date(start)
+    e = _parse_date(end)
+    if e < s:
+        raise HTTPException(status_code=400, detail="end must be >= start")
+    if (e - s).days + 1 > RECURRENCE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"range must be <= {RECURRENCE_MAX_DAYS} days")
+    if step % SLOT_MINUTES:
+        raise HTTPException(status_code=400, detail=f"step must be a multiple of {SLOT_MINUTES}")
+
+    k = (kind or "").strip().replace("\u3000", "")
+    if not k:
+        raise HTTPException(status_code=422, detail="kind is required")
+
+    m_from = _parse_hhmm(time_from) if time_from else OPEN_HOUR * 60
+    # 23:00 までなど 24 時未満に収まる前提（time 型は日をまたげない）
+    m_to = _parse_hhmm(time_to) if time_to else min(CLOSE_HOUR * 60, 24 * 60 - 1)
+    if m_from % SLOT_MINUTES:
+        raise HTTPException(status_code=400, detail=f"from must be aligned to {SLOT_MINUTES} minutes")
+    n = (m_to - m_from) // step
+    if n <= 0:
+        return {"kind": k, "step": step, "slots": [], "more": False}
+
+    params = {"s": s, "e": e, "k": k, "m_from": m_from, "step": step, "n": n, "lim": limit + 1}
+    rows = read_with_fallback(
+        lambda conn: conn.execute(text(_AVAILABLE_SLOTS_SQL), params).mappings().all(),
+        min_lsn=_min_lsn(request, LSN_COOKIE))
+
+    return {
+        "kind": k,
+        "step": step,
+        "slots": [{"day": r["d"], "time": r["t"]} for r in rows[:limit]],
+        "more": len(rows) > limit,
+    }
+
+# =============================
+# 予約枠の変化をプッシュ（SSE）
+#   event: booked / released  data: {"kind","day","times":[...]}
+#   event: resync             → クライアントは /api/truck/booked を取り直す
+# =============================
+notify_hub.register("slot_changes")
+
+@app.get("/api/truck/booked/stream")
+async def stream_booked_slots_truck(
+    request: Request,
+    kind: str  = Query(..., description="対象kind（アドトラック)"),
+    start: Optional[str] = Query(None, description="YYYY-MM-DD（含む・任意）"),
+    end: Optional[str]   = Query(None, description="YYYY-MM-DD（含む・任意）"),
+):
+    k = (kind or "").strip().replace("\u3000", "")
+    if not k:
+        raise HTTPException(status_code=422, detail="kind is required")
+    s = _parse_date(start).isoformat() if start else None
+    e = _parse_date(end).isoformat() if end else None
+
+    # YYYY-MM-DD は文字列比較で範囲判定できる
+    def accept(ev: Dict) -> bool:
+        d = ev.get("day") or ""
+        return ev.get("kind") == k and (s is None or d >= s) and (e is None or d <= e)
+
+    return sse_response(request, "slot_changes", accept)
+
 # ==== 追加: スキーマ ====
 class AdminMeOut(BaseModel):
     id: int
@@ -872,18 +2065,20 @@ class AdminRenameIn(BaseModel):
 
 # ==== 追加: 管理者の自己情報取得 ====
 @app.get("/api/auth/admin/me", response_model=AdminMeOut)
-def admin_me(claims=Depends(require_admin)):
+def admin_me(request: Request, claims=Depends(require_admin)):
     uid = int(claims["sub"])
-    with engine_admin.begin() as conn:
-        row = conn.execute(text("""
-            SELECT id, username, display_name, is_active
-            FROM admin_users WHERE id=:id LIMIT 1
-        """), {"id": uid}).mappings().first()
+    sql = text("""
+        SELECT id, username, display_name, is_active
+        FROM admin_users WHERE id=:id LIMIT 1
+    """)
+    row = read_with_fallback(
+        lambda conn: conn.execute(sql, {"id": uid}).mappings().first(),
+        engine_admin, engine_admin_ro, _min_lsn(request, ADMIN_LSN_COOKIE))
     if not row: raise HTTPException(status_code=403, detail="not allowed")
     return {"id": int(row["id"]), "username": row["username"], "display_name": row.get("display_name"), "is_active": bool(row["is_active"])}
 
 @app.post("/api/auth/admin/change_password")
-def change_admin_password(p: AdminPwChangeIn, claims=Depends(require_admin)):
+def change_admin_password(p: AdminPwChangeIn, response: Response, claims=Depends(require_admin)):
     uid = int(claims["sub"])
     if len(p.new_password or "") < 6:
         raise HTTPException(status_code=400, detail="new password too short")
@@ -894,10 +2089,11 @@ def change_admin_password(p: AdminPwChangeIn, claims=Depends(require_admin)):
             raise HTTPException(status_code=401, detail="current password mismatch")
         conn.execute(text("UPDATE admin_users SET password_hash=:h WHERE id=:id"),
                      {"h": pwd_ctx.hash(p.new_password), "id": uid})
+    remember_write(response, engine_admin, ADMIN_LSN_COOKIE)
     return {"ok": True}
 
 @app.post("/api/auth/admin/rename")
-def rename_admin_username(p: AdminRenameIn, claims=Depends(require_admin)):
+def rename_admin_username(p: AdminRenameIn, response: Response, claims=Depends(require_admin)):
     uid = int(claims["sub"])
     new_uname = (p.new_username or "").strip()
     if not new_uname: raise HTTPException(status_code=400, detail="username is required")
@@ -910,6 +2106,7 @@ def rename_admin_username(p: AdminRenameIn, claims=Depends(require_admin)):
                               {"u": new_uname, "id": uid}).first()
         if exists: raise HTTPException(status_code=409, detail="username already exists")
         conn.execute(text("UPDATE admin_users SET username=:u WHERE id=:id"), {"u": new_uname, "id": uid})
+    remember_write(response, engine_admin, ADMIN_LSN_COOKIE)
     return {"ok": True, "username": new_uname}
 
 # =========================================================
@@ -920,11 +2117,55 @@ def _file_path_to_url(p: Optional[str]) -> str:
     """
     submission_files.path には "./uploads/xxxx.png" のようなパスが入る実装。
     表示用URLは {API_ORIGIN}/uploads/<ファイル名> に正規化する。
+    S3 に置いたもの（"s3://bucket/key"）はバケットの公開URLにする。
     """
     if not p:
         return ""
-    name = Path(p).name
-    return f"{API_ORIGIN}/uploads/{name}"
+    if p.startswith("s3://") and storage is not local_storage:
+        return storage.url(p)
+    return local_storage.url(p)
+
+def _file_url_sql(col: str) -> str:
+    """_file_path_to_url と同じ変換を SQL 式で（_file_url_params() をバインドすること）"""
+    return (f"CASE WHEN COALESCE({col}, '') = '' THEN '' "
+            f"WHEN {col} LIKE 's3://%' AND CAST(:s3_base AS TEXT) IS NOT NULL "
+            f"THEN :s3_base || '/' || regexp_replace({col}, '^s3://[^/]+/', '') "
+            f"ELSE :api_origin || '/uploads/' || regexp_replace({col}, '^.*/', '') END")
+
+def _file_url_params() -> Dict:
+    return {
+        "api_origin": API_ORIGIN,
+        "s3_base": storage.public_base if storage is not local_storage else None,
+    }
+
+# 合成画像のキャッシュキー（描画に効く列だけから作る。版を上げると全件作り直し）
+_RENDER_VERSION = "1"
+
+# 合成の元にする先頭の画像ファイル（file_keys の並びによっては先頭が音声のこともある）
+_FIRST_IMAGE_JOIN_SQL = """
+      LEFT JOIN LATERAL (
+        SELECT sf.path
+          FROM submission_files sf
+         WHERE sf.submission_id = s.id
+           AND sf.mime LIKE 'image/%'
+         ORDER BY sf.id ASC
+         LIMIT 1
+      ) ip ON TRUE
+"""
+
+def _render_key_sql(s: str, path_col: str) -> str:
+    return (f"md5(json_build_array('{_RENDER_VERSION}', {path_col}, {s}.overlay, {s}.lines, "
+            f"{s}.text_color, {s}.title, {s}.message, {s}.caption)::text)")
+
+def _rendered_url(submission_id: int, key: Optional[str]) -> Optional[str]:
+    if not key:
+        return None
+    return f"{API_ORIGIN}/api/render/{int(submission_id)}/{key}.jpg"
+
+def _rendered_url_sql(s: str, path_col: str) -> str:
+    """_rendered_url と同じ URL を SQL 式で（:api_origin をバインドすること）"""
+    return (f"CASE WHEN COALESCE({path_col}, '') = '' THEN NULL "
+            f"ELSE :api_origin || '/api/render/' || {s}.id || '/' || {_render_key_sql(s, path_col)} || '.jpg' END")
 
 class SubmissionOut(BaseModel):
     id: int
@@ -938,55 +2179,167 @@ class SubmissionOut(BaseModel):
     lines: Optional[List[str]] = None
     textColor: Optional[str] = None
     overlay: Optional[dict] = None   # ★ 追加: プレビュー配置・値
+    renderedUrl: Optional[str] = None  # ★ 追加: 文字を合成済みの画像
+
+# 審査一覧・SSE 共通の SELECT（WHERE / ORDER BY は呼び出し側で付ける）
+_SUBMISSION_OUT_SQL = f"""
+    SELECT s.id,
+           s.status,
+           NULLIF(s.company_name, '') AS company_name,
+           s.title,
+           s.created_at,
+           s.message, s.caption, s.text_color, s.lines, s.overlay,
+           fp.path AS first_path,
+           ip.path AS image_path,
+           {_render_key_sql("s", "ip.path")} AS render_key
+      FROM submissions s
+      LEFT JOIN LATERAL (
+        SELECT sf.path
+          FROM submission_files sf
+         WHERE sf.submission_id = s.id
+         ORDER BY sf.id ASC
+         LIMIT 1
+      ) fp ON TRUE
+{_FIRST_IMAGE_JOIN_SQL}"""
+
+def _normalize_lines(v) -> Optional[List[str]]:
+    """lines は文字列配列として返す（旧データの数値などは JSON 表記の文字列に、null は捨てる）"""
+    if not isinstance(v, list):
+        return None
+    return [x if isinstance(x, str) else json.dumps(x, ensure_ascii=False) for x in v if x is not None]
+
+def _submission_row_to_out(r) -> SubmissionOut:
+    company = r["company_name"] or r["title"] or ""
+    image_url = _file_path_to_url(r["first_path"])
+    submitted_at = (r["created_at"] or datetime.utcnow()).isoformat()
+    lines_val = _normalize_lines(r.get("lines"))
+    return SubmissionOut(
+        id=int(r["id"]),
+        companyName=company,
+        imageUrl=image_url,
+        title=r["title"],
+        submittedAt=submitted_at,
+        message=r.get("message"),
+        caption=r.get("caption"),
+        lines=lines_val,
+        textColor=r.get("text_color"),
+        overlay=r.get("overlay"),
+        renderedUrl=_rendered_url(r["id"], r["render_key"]) if r["image_path"] else None,
+    )
+
+def _iso_ts_sql(col: str) -> str:
+    """datetime.isoformat() と同じ表記（マイクロ秒が 0 なら省略、末尾ゼロは残す）"""
+    return (f"to_char({col}, 'YYYY-MM-DD\"T\"HH24:MI:SS') "
+            f"|| CASE WHEN to_char({col}, 'US') <> '000000' THEN '.' || to_char({col}, 'US') ELSE '' END "
+            f"|| to_char({col}, 'TZH:TZM')")
+
+def _lines_sql(col: str) -> str:
+    """_normalize_lines と同じ正規化を SQL 式で"""
+    return (f"CASE WHEN jsonb_typeof({col}) = 'array' THEN ("
+            f"SELECT COALESCE(json_agg(e.v #>> '{{}}' ORDER BY e.o), '[]'::json) "
+            f"FROM jsonb_array_elements({col}) WITH ORDINALITY AS e(v, o) "
+            f"WHERE jsonb_typeof(e.v) <> 'null') END")
+
+# 高速モード: SubmissionOut と同じ形の JSON 配列を Postgres 側で組み立てる
+#   （Python で行→モデル→JSON を作らない。通常モードとの一致は scripts/bench_review_queue.py で確認）
+_SUBMISSION_OUT_JSON_SQL = f"""
+    SELECT COALESCE(json_agg(json_build_object(
+             'id', s.id,
+             'companyName', COALESCE(NULLIF(s.company_name, ''), s.title, ''),
+             'imageUrl', {_file_url_sql("fp.path")},
+             'title', s.title,
+             'submittedAt', {_iso_ts_sql("COALESCE(s.created_at, now())")},
+             'message', s.message,
+             'caption', s.caption,
+             'lines', {_lines_sql("s.lines")},
+             'textColor', s.text_color,
+             'overlay', CASE WHEN jsonb_typeof(s.overlay) = 'object' THEN s.overlay END,
+             'renderedUrl', {_rendered_url_sql("s", "ip.path")}
+           ) ORDER BY s.created_at DESC, s.id DESC), '[]')::text
+      FROM submissions s
+      LEFT JOIN LATERAL (
+        SELECT sf.path
+          FROM submission_files sf
+         WHERE sf.submission_id = s.id
+         ORDER BY sf.id ASC
+         LIMIT 1
+      ) fp ON TRUE
+{_FIRST_IMAGE_JOIN_SQL}
+     WHERE s.status = :st
+"""
 
 @app.get("/api/admin/review/queue", response_model=List[SubmissionOut])
-def list_review_queue(status: str = Query("pending"), claims=Depends(require_admin)):
+def list_review_queue(
+    request: Request,
+    status: str = Query("pending"),
+    fast: bool = Query(False, description="true: DB で組み立てた JSON をそのまま返す"),
+    claims=Depends(require_admin),
+):
     st = (status or "pending").lower()
     if st not in ("pending", "approved", "rejected"):
         raise HTTPException(status_code=400, detail="invalid status")
+    min_lsn = _min_lsn(request, LSN_COOKIE)
+    if fast:
+        params = {"st": st, **_file_url_params()}
+        body = read_with_fallback(
+            lambda conn: conn.execute(text(_SUBMISSION_OUT_JSON_SQL), params).scalar_one(),
+            min_lsn=min_lsn)
+        return Response(content=body, media_type="application/json")
+    sql = text(_SUBMISSION_OUT_SQL + """
+         WHERE s.status = :st
+         ORDER BY s.created_at DESC, s.id DESC
+    """)
+    rows = read_with_fallback(lambda conn: conn.execute(sql, {"st": st}).mappings().all(), min_lsn=min_lsn)
+
+    return [_submission_row_to_out(r) for r in rows]
+
+# =============================
+# 審査キューの差分配信（SSE）
+#   event: created / status_changed
+#   data: {"event","id","status","submission": SubmissionOut}
+#   ※ NOTIFY はコミット時に配送されるのでロールバック分は届かない
+# =============================
+def _notify_submission(conn, submission_id: int, event: str) -> None:
+    conn.execute(
+        text("SELECT pg_notify('submission_events', :p)"),
+        {"p": json.dumps({"event": event, "id": int(submission_id)})},
+    )
+
+def _submission_event_transform(payload: str) -> Optional[Dict]:
+    """LISTEN スレッド内で 1 イベントにつき 1 回だけ SubmissionOut を組み立てる"""
+    ev = json.loads(payload)
     with engine.begin() as conn:
-        rows = conn.execute(text("""
-            SELECT s.id,
-                   NULLIF(s.company_name, '') AS company_name,
-                   s.title,
-                   s.created_at,
-                   s.message, s.caption, s.text_color, s.lines, s.overlay,
-                   (
-                     SELECT sf.path
-                       FROM submission_files sf
-                      WHERE sf.submission_id = s.id
-                      ORDER BY sf.id ASC
-                      LIMIT 1
-                   ) AS first_path
-              FROM submissions s
-             WHERE s.status = :st
-             ORDER BY s.created_at DESC
-        """), {"st": st}).mappings().all()
+        r = conn.execute(text(_SUBMISSION_OUT_SQL + " WHERE s.id = :id"),
+                         {"id": int(ev["id"])}).mappings().first()
+    if not r:
+        return None
+    return {
+        "event": ev.get("event"),
+        "id": int(r["id"]),
+        "status": r["status"],
+        "submission": _submission_row_to_out(r).model_dump(),
+    }
 
-    out: List[SubmissionOut] = []
-    for r in rows:
-        company = r["company_name"] or r["title"] or ""
-        image_url = _file_path_to_url(r["first_path"])
-        submitted_at = (r["created_at"] or datetime.utcnow()).isoformat()
-        lines_val = r.get("lines")
-        if not isinstance(lines_val, list):
-            lines_val = None
-        out.append(SubmissionOut(
-            id=int(r["id"]),
-            companyName=company,
-            imageUrl=image_url,
-            title=r["title"],
-            submittedAt=submitted_at,
-            message=r.get("message"),
-            caption=r.get("caption"),
-            lines=lines_val,
-            textColor=r.get("text_color"),
-            overlay=r.get("overlay"),
-        ))
-    return out
+notify_hub.register("submission_events", _submission_event_transform)
+
+@app.get("/api/admin/review/stream")
+async def stream_review_queue(
+    request: Request,
+    status: Optional[str] = Query(None, description="pending / approved / rejected（省略時は全件）"),
+    claims=Depends(require_admin),
+):
+    st = (status or "").lower() or None
+    if st not in (None, "pending", "approved", "rejected"):
+        raise HTTPException(status_code=400, detail="invalid status")
+
+    # status_changed は一覧から外す判断にも使うので status に関係なく送る
+    def accept(ev: Dict) -> bool:
+        return st is None or ev.get("event") == "status_changed" or ev.get("status") == st
+
+    return sse_response(request, "submission_events", accept)
 
 @app.post("/api/admin/review/{submission_id}/approve")
-def approve_submission(submission_id: int, claims=Depends(require_admin)):
+def approve_submission(submission_id: int, response: Response, claims=Depends(require_admin)):
     with engine.begin() as conn:
         row = conn.execute(text("SELECT status FROM submissions WHERE id=:id"), {"id": submission_id}).first()
         if not row:
@@ -996,10 +2349,13 @@ def approve_submission(submission_id: int, claims=Depends(require_admin)):
                SET status='approved', decided_at=now()
              WHERE id=:id
         """), {"id": submission_id})
+        _notify_submission(conn, submission_id, "status_changed")
+        rebuild_manifests_for_submission(conn, submission_id)
+    remember_write(response, engine, LSN_COOKIE)
     return {"ok": True}
 
 @app.post("/api/admin/review/{submission_id}/reject")
-def reject_submission(submission_id: int, claims=Depends(require_admin)):
+def reject_submission(submission_id: int, response: Response, claims=Depends(require_admin)):
     with engine.begin() as conn:
         row = conn.execute(text("SELECT status FROM submissions WHERE id=:id"), {"id": submission_id}).first()
         if not row:
@@ -1009,4 +2365,1053 @@ def reject_submission(submission_id: int, claims=Depends(require_admin)):
                SET status='rejected', decided_at=now()
              WHERE id=:id
         """), {"id": submission_id})
+        _notify_submission(conn, submission_id, "status_changed")
+        # 承認済みからの却下だけ再生表に影響する
+        if row[0] == "approved":
+            rebuild_manifests_for_submission(conn, submission_id)
+    remember_write(response, engine, LSN_COOKIE)
     return {"ok": True}
+
+# =========================================================
+# 追加: 再生マニフェスト（トラック/サイネージ端末がポーリングする再生表）
+#   承認・却下のたびに該当 kind×day を再コンパイルし、内容が変わったときだけ新しい版を保存。
+#   端末は ETag 付きで最新版を取得し、版指定 URL は不変（immutable）として配信する。
+# =========================================================
+def _manifest_etag(items: List[Dict]) -> str:
+    canon = json.dumps(items, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()[:32]
+
+def rebuild_manifests(conn, kind: str, days: List[str]) -> None:
+    """kind×days の再生表を組み直す（承認済み申請のみ。呼び出し側のトランザクション内で実行）"""
+    days = sorted(set(days))
+    if not days:
+        return
+    # 同じ kind×day の同時再構築を直列化（ロック順は日付順で固定）
+    for d in days:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('manifest:' || :k || ':' || :d))"),
+                     {"k": kind, "d": d})
+
+    slots = conn.execute(text("""
+        SELECT rs.day::text AS d, to_char(rs.time, 'HH24:MI') AS t, rs.submission_id AS sid
+          FROM reservation_slots rs
+          JOIN submissions s ON s.id = rs.submission_id
+         WHERE rs.kind = :k
+           AND rs.day = ANY(CAST(:days AS date[]))
+           AND s.status = 'approved'
+         ORDER BY rs.day, rs.time
+    """), {"k": kind, "days": days}).mappings().all()
+
+    sids = sorted({int(r["sid"]) for r in slots})
+    subs: Dict[int, Dict] = {}
+    if sids:
+        for r in conn.execute(text(f"""
+            SELECT s.id, s.title, s.message, s.caption, s.text_color, s.lines, s.overlay,
+                   ip.path AS image_path, {_render_key_sql("s", "ip.path")} AS render_key
+              FROM submissions s
+              {_FIRST_IMAGE_JOIN_SQL}
+             WHERE s.id = ANY(:ids)
+        """), {"ids": sids}).mappings().all():
+            subs[int(r["id"])] = {
+                "renderedUrl": _rendered_url(r["id"], r["render_key"]) if r["image_path"] else None,
+                "title": r["title"],
+                "message": r["message"],
+                "caption": r["caption"],
+                "lines": r["lines"] if isinstance(r["lines"], list) else None,
+                "textColor": r["text_color"],
+                "overlay": r["overlay"],
+                "files": [],
+                "audio": None,
+            }
+        for r in conn.execute(text("""
+            SELECT submission_id, path, mime
+              FROM submission_files
+             WHERE submission_id = ANY(:ids)
+               AND (media_status IS NULL OR media_status = 'done')
+             ORDER BY submission_id, id
+        """), {"ids": sids}).mappings().all():
+            sub = subs[int(r["submission_id"])]
+            url = _file_path_to_url(r["path"])
+            if (r["mime"] or "").startswith("audio/"):
+                sub["audio"] = sub["audio"] or url
+            else:
+                sub["files"].append(url)
+
+    items_by_day: Dict[str, List[Dict]] = {d: [] for d in days}
+    for r in slots:
+        sid = int(r["sid"])
+        items_by_day[r["d"]].append({"time": r["t"], "submissionId": sid, **subs[sid]})
+
+    latest = {
+        r["d"]: (r["version"], r["etag"])
+        for r in conn.execute(text("""
+            SELECT DISTINCT ON (day) day::text AS d, version, etag
+              FROM playback_manifests
+             WHERE kind = :k AND day = ANY(CAST(:days AS date[]))
+             ORDER BY day, version DESC
+        """), {"k": kind, "days": days}).mappings().all()
+    }
+    for d in days:
+        items = items_by_day[d]
+        etag = _manifest_etag(items)
+        prev_version, prev_etag = latest.get(d, (0, None))
+        if etag == prev_etag:
+            continue
+        version = prev_version + 1
+        body = json.dumps({"kind": kind, "day": d, "version": version, "items": items},
+                          ensure_ascii=False, separators=(",", ":"))
+        conn.execute(text("""
+            INSERT INTO playback_manifests(kind, day, version, etag, body)
+            VALUES (:k, :d, :v, :etag, :body)
+        """), {"k": kind, "d": d, "v": version, "etag": etag, "body": body})
+        conn.execute(text("""
+            DELETE FROM playback_manifests
+             WHERE kind = :k AND day = :d AND version <= :v - :keep
+        """), {"k": kind, "d": d, "v": version, "keep": MANIFEST_KEEP_VERSIONS})
+
+def rebuild_manifests_for_submission(conn, submission_id: int) -> None:
+    row = conn.execute(text("SELECT kind FROM submissions WHERE id=:id"), {"id": submission_id}).first()
+    if not row:
+        return
+    days = conn.execute(text("""
+        SELECT DISTINCT day::text FROM reservation_slots WHERE submission_id = :id
+    """), {"id": submission_id}).scalars().all()
+    rebuild_manifests(conn, row[0], list(days))
+
+# (kind, day) -> (期限, version, etag, body)。ポーリングの大半を DB に届かせない
+#   任意の day で問い合わせられるので件数上限付きの LRU にする
+_manifest_cache: "OrderedDict[Tuple[str, str], Tuple[float, int, str, str]]" = OrderedDict()
+_manifest_cache_lock = threading.Lock()
+
+def _empty_manifest(kind: str, day: str) -> Tuple[int, str, str]:
+    """承認済みの枠が無い日の版 0（保存しない）"""
+    body = json.dumps({"kind": kind, "day": day, "version": 0, "items": []},
+                      ensure_ascii=False, separators=(",", ":"))
+    return 0, _manifest_etag([]), body
+
+def _load_latest_manifest(kind: str, day: str) -> Tuple[int, str, str]:
+    if kind not in PLAYBACK_KINDS:
+        return _empty_manifest(kind, day)
+    key = (kind, day)
+    now = time.monotonic()
+    with _manifest_cache_lock:
+        hit = _manifest_cache.get(key)
+        if hit and hit[0] > now:
+            _manifest_cache.move_to_end(key)
+            return hit[1], hit[2], hit[3]
+    sql = text("""
+        SELECT version, etag, body
+          FROM playback_manifests
+         WHERE kind = :k AND day = :d
+         ORDER BY version DESC
+         LIMIT 1
+    """)
+    def read(conn):
+        row = conn.execute(sql, {"k": kind, "d": day}).first()
+        has_slots = row is not None or conn.execute(text("""
+            SELECT EXISTS (
+              SELECT 1
+                FROM reservation_slots rs
+                JOIN submissions s ON s.id = rs.submission_id
+               WHERE rs.kind = :k AND rs.day = :d AND s.status = 'approved'
+            )
+        """), {"k": kind, "d": day}).scalar()
+        return row, has_slots
+    row, has_slots = read_with_fallback(read)
+    if row:
+        out = (int(row[0]), row[1], row[2])
+    elif has_slots:
+        # 承認済みの枠があるのに未コンパイル（機能追加前の承認など）の日だけ primary で作る
+        with engine.begin() as conn:
+            rebuild_manifests(conn, kind, [day])
+            row = conn.execute(sql, {"k": kind, "d": day}).first()
+        out = (int(row[0]), row[1], row[2])
+    else:
+        out = _empty_manifest(kind, day)
+    with _manifest_cache_lock:
+        _manifest_cache[key] = (now + MANIFEST_CACHE_SECONDS, *out)
+        _manifest_cache.move_to_end(key)
+        while len(_manifest_cache) > MANIFEST_CACHE_MAX_ENTRIES:
+            _manifest_cache.popitem(last=False)
+    return out
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/").strip('"') for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+@app.get("/api/playback/manifest")
+def get_playback_manifest(
+    kind: str = Query(...),
+    day: str = Query(..., description="YYYY-MM-DD"),
+    if_none_match: Optional[str] = Header(None),
+):
+    k = (kind or "").strip().replace("\u3000", "")
+    if not k:
+        raise HTTPException(status_code=422, detail="kind is required")
+    d = _parse_date(day).isoformat()
+    version, etag, body = _load_latest_manifest(k, d)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "no-cache",
+        "X-Manifest-Version": str(version),
+    }
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/playback/manifest/{kind}/{day}/{version}")
+def get_playback_manifest_version(kind: str, day: str, version: int):
+    d = _parse_date(day).isoformat()
+    sql = text("""
+        SELECT etag, body FROM playback_manifests
+         WHERE kind = :k AND day = :d AND version = :v
+    """)
+    row = read_with_fallback(lambda conn: conn.execute(sql, {"k": kind, "d": d, "v": version}).first())
+    if not row:
+        raise HTTPException(status_code=404, detail="not found")
+    return Response(
+        content=row[1],
+        media_type="application/json",
+        headers={"ETag": f'"{row[0]}"', "Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+def _stats_fold_loop() -> None:
+    while True:
+        time.sleep(STATS_FOLD_INTERVAL_SECONDS)
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT stats_fold()"))
+        except Exception as e:
+            print("stats fold failed:", e)
+
+# =========================================================
+# 追加: 集計API（ロールアップ＋未畳み込みの差分のみを参照）
+#   report=occupancy : group_by = day / hour / kind  → booked / capacity / fillRate
+#   report=decisions : group_by = company / day      → submitted / approved / rejected
+#   ※ capacity / fillRate は kind 指定時（または group_by=kind）のみ算出
+# =========================================================
+@app.get("/api/admin/stats")
+def admin_stats(
+    start: str = Query(..., description="YYYY-MM-DD（含む）"),
+    end: str   = Query(..., description="YYYY-MM-DD（含む）"),
+    report: str = Query("occupancy", description="occupancy / decisions"),
+    group_by: str = Query("day", description="occupancy: day/hour/kind, decisions: company/day"),
+    kind: Optional[str] = Query(None),
+    claims=Depends(require_admin),
+):
+    s = _parse_date(start)
+    e = _parse_date(end)
+    if e < s:
+        raise HTTPException(status_code=400, detail="end must be >= start")
+    k = (kind or "").strip().replace("\u3000", "") or None
+    rp = (report or "").lower()
+    gb = (group_by or "").lower()
+    params = {"s": s, "e": e, "k": k}
+
+    if rp == "occupancy":
+        key_sql = {"day": "day::text", "hour": "hour", "kind": "kind"}.get(gb)
+        if key_sql is None:
+            raise HTTPException(status_code=400, detail="invalid group_by")
+        sql = text(f"""
+            SELECT {key_sql} AS key, sum(booked)::int AS booked
+              FROM (
+                SELECT kind, day, hour, booked FROM stats_slots_hourly
+                UNION ALL
+                SELECT kind, day, hour, booked FROM stats_slots_delta
+              ) x
+             WHERE day BETWEEN :s AND :e
+               AND (CAST(:k AS TEXT) IS NULL OR kind = :k)
+             GROUP BY 1
+             ORDER BY 1
+        """)
+        rows = read_with_fallback(lambda conn: conn.execute(sql, params).mappings().all())
+
+        # 1 kind あたりの枠数
+        per_hour = 60 // SLOT_MINUTES
+        days = (e - s).days + 1
+        per_group = {
+            "day": per_hour * (CLOSE_HOUR - OPEN_HOUR),
+            "kind": per_hour * (CLOSE_HOUR - OPEN_HOUR) * days,
+        }
+        items = []
+        for r in rows:
+            capacity = None
+            if k is not None or gb == "kind":
+                if gb == "hour":
+                    capacity = per_hour * days if OPEN_HOUR <= int(r["key"]) < CLOSE_HOUR else 0
+                else:
+                    capacity = per_group[gb]
+            items.append({
+                "key": r["key"],
+                "booked": r["booked"],
+                "capacity": capacity,
+                "fillRate": round(r["booked"] / capacity, 4) if capacity else None,
+            })
+    elif rp == "decisions":
+        key_sql = {"company": "company_name", "day": "day::text"}.get(gb)
+        if key_sql is None:
+            raise HTTPException(status_code=400, detail="invalid group_by")
+        sql = text(f"""
+            SELECT {key_sql} AS key,
+                   sum(n) FILTER (WHERE status = 'submitted')::int AS submitted,
+                   sum(n) FILTER (WHERE status = 'approved')::int  AS approved,
+                   sum(n) FILTER (WHERE status = 'rejected')::int  AS rejected
+              FROM (
+                SELECT kind, company_name, day, status, n FROM stats_decisions_daily
+                UNION ALL
+                SELECT kind, company_name, day, status, n FROM stats_decisions_delta
+              ) x
+             WHERE day BETWEEN :s AND :e
+               AND (CAST(:k AS TEXT) IS NULL OR kind = :k)
+             GROUP BY 1
+             ORDER BY 1
+        """)
+        rows = read_with_fallback(lambda conn: conn.execute(sql, params).mappings().all())
+        items = [{
+            "key": r["key"],
+            "submitted": r["submitted"] or 0,
+            "approved": r["approved"] or 0,
+            "rejected": r["rejected"] or 0,
+        } for r in rows]
+    else:
+        raise HTTPException(status_code=400, detail="invalid report")
+
+    return {"report": rp, "group_by": gb, "start": s.isoformat(), "end": e.isoformat(), "kind": k, "items": items}
+
+# =========================================================
+# 追加: 会計向けエクスポート（COPY ... TO STDOUT をそのままストリーミング）
+#   table  : submissions / submission_files / reservation_slots
+#   format : csv（ヘッダ付き） / ndjson
+#   start/end: submissions・submission_files は申請日（created_at）、reservation_slots は予約日（day）
+#   status : 申請の status で絞り込み
+#   gzip   : true なら .gz で返す
+# =========================================================
+_EXPORT_SQL = {
+    "submissions": ("""
+        SELECT s.id, s.kind, s.title, s.company_name, s.status, s.created_at, s.decided_at,
+               s.message, s.caption, s.text_color, s.lines, s.overlay, s.schedule_rule
+          FROM submissions s
+    """, "s.created_at::date", "s.id"),
+    "submission_files": ("""
+        SELECT sf.id, sf.submission_id, sf.path, sf.original_name, sf.mime, sf.size
+          FROM submission_files sf
+          JOIN submissions s ON s.id = sf.submission_id
+    """, "s.created_at::date", "sf.id"),
+    "reservation_slots": ("""
+        SELECT rs.kind, rs.day, rs.time, rs.submission_id, s.status, rs.created_at
+          FROM reservation_slots rs
+          JOIN submissions s ON s.id = rs.submission_id
+    """, "rs.day", "rs.kind, rs.day, rs.time"),
+}
+
+_EXPORT_EOF = object()
+
+class ExportFailed(RuntimeError):
+    """COPY が途中で失敗した。レスポンスを正常終了させずに接続ごと打ち切るために送出する"""
+
+class _CopyPipe:
+    """copy_expert の書き込み先。有界キューでレスポンス側と速度を合わせる（バックプレッシャ）"""
+
+    def __init__(self, gz: bool):
+        self.q: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+        self.closed = threading.Event()
+        self.z = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+
+    def _put(self, data: bytes) -> None:
+        while True:
+            if self.closed.is_set():
+                raise IOError("export client disconnected")
+            try:
+                self.q.put(data, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.z is not None:
+            data = self.z.compress(data)
+        if data:
+            self._put(data)
+
+    def finish(self) -> None:
+        if self.z is not None:
+            self._put(self.z.flush())
+
+    def end(self, item) -> None:
+        """終端（_EXPORT_EOF か ExportFailed）を届ける。切断済みなら捨てる"""
+        try:
+            self._put(item)
+        except IOError:
+            pass
+
+def _run_copy(sql: str, params: Dict, copy_opts: str, pipe: _CopyPipe) -> None:
+    end = _EXPORT_EOF
+    raw = None
+    try:
+        try:
+            raw = engine_ro.raw_connection()
+        except OperationalError as e:
+            if engine_ro is engine:
+                raise
+            print("replica connect failed, exporting from primary:", e)
+            raw = engine.raw_connection()
+        cur = raw.cursor()
+        inner = cur.mogrify(sql, params).decode("utf-8")
+        cur.copy_expert(f"COPY ({inner}) TO STDOUT WITH ({copy_opts})", pipe, size=EXPORT_CHUNK_BYTES)
+        pipe.finish()
+        raw.rollback()
+    except Exception as e:
+        print("export failed:", e)
+        end = ExportFailed(str(e))
+        # COPY 途中で止めた接続はプールに戻さない
+        if raw is not None:
+            raw.invalidate()
+    finally:
+        if raw is not None:
+            raw.close()
+        pipe.end(end)
+
+@app.get("/api/admin/export")
+def admin_export(
+    table: str = Query(..., description="submissions / submission_files / reservation_slots"),
+    format: str = Query("csv", description="csv / ndjson"),
+    start: Optional[str] = Query(None, description="YYYY-MM-DD（含む）"),
+    end: Optional[str] = Query(None, description="YYYY-MM-DD（含む）"),
+    status: Optional[str] = Query(None),
+    gzip: bool = Query(False),
+    claims=Depends(require_admin),
+):
+    if table not in _EXPORT_SQL:
+        raise HTTPException(status_code=400, detail="invalid table")
+    fmt = (format or "").lower()
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="invalid format")
+    st = (status or "").lower() or None
+    if st not in (None, "pending", "approved", "rejected"):
+        raise HTTPException(status_code=400, detail="invalid status")
+
+    base, date_col, order_by = _EXPORT_SQL[table]
+    where: List[str] = []
+    params: Dict = {}
+    if start:
+        where.append(f"{date_col} >= %(s)s")
+        params["s"] = _parse_date(start)
+    if end:
+        where.append(f"{date_col} <= %(e)s")
+        params["e"] = _parse_date(end)
+    if st:
+        where.append("s.status = %(st)s")
+        params["st"] = st
+    sql = base + (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY {order_by}"
+
+    if fmt == "csv":
+        copy_opts = "FORMAT csv, HEADER true"
+        media_type, ext = "text/csv", "csv"
+    else:
+        # 1 行 = row_to_json。引用符/区切りに JSON に現れない制御文字を使い、COPY のエスケープを避ける
+        sql = f"SELECT row_to_json(t) FROM ({sql}) t"
+        copy_opts = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+        media_type, ext = "application/x-ndjson", "ndjson"
+    filename = f"{table}.{ext}"
+    if gzip:
+        media_type, filename = "application/gzip", filename + ".gz"
+
+    pipe = _CopyPipe(gzip)
+    worker = threading.Thread(target=_run_copy, args=(sql, params, copy_opts, pipe), daemon=True)
+
+    def gen():
+        worker.start()
+        try:
+            while True:
+                item = pipe.q.get()
+                if item is _EXPORT_EOF:
+                    break
+                if isinstance(item, ExportFailed):
+                    # 送信済みの分を完全なファイルに見せない（chunked の終端を送らずに切る）
+                    raise item
+                yield item
+        finally:
+            # 途中切断時は COPY 側の write を失敗させて終了させる
+            pipe.closed.set()
+
+    return StreamingResponse(
+        gen(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+# =========================================================
+# 追加: 直接アップロード（API を経由せずにストレージへ PUT）
+#   1) POST /api/uploads/presign で key と PUT 先 URL を受け取る
+#   2) クライアントが URL へ PUT
+#   3) /api/trucks・/api/submit/bulk に file_keys（JSON配列）で key だけ送る
+#      → 登録時に incoming からサーバ採番の key へ移す（storage.claim）。URL の期限内に再 PUT されても登録済みの中身は変わらない
+#   ※ PUT 先は incoming（UPLOAD_INCOMING_DIR / S3 の incoming/）で、/uploads には出ない
+#   ※ local バックエンドでは PUT 先が本 API（/api/uploads/direct）になる
+# =========================================================
+class PresignFileIn(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    contentType: str = Field("application/octet-stream", max_length=128)
+
+class PresignIn(BaseModel):
+    files: List[PresignFileIn] = Field(..., min_length=1, max_length=100)
+
+@app.post("/api/uploads/presign")
+def presign_uploads(p: PresignIn):
+    out = []
+    for f in p.files:
+        key = new_upload_key(f.filename)
+        out.append({"key": key, "name": f.filename, "contentType": f.contentType,
+                    **storage.presign_put(key, f.contentType)})
+    return {"ok": True, "uploads": out}
+
+@app.put("/api/uploads/direct/{key}")
+async def direct_upload(key: str, request: Request, exp: int = Query(...), sig: str = Query(...)):
+    if storage is not local_storage:
+        raise HTTPException(status_code=404, detail="not found")
+    if not _UPLOAD_KEY_RE.match(key):
+        raise HTTPException(status_code=400, detail="invalid key")
+    content_type = request.headers.get("content-type", "")
+    expected = _sign_direct_upload(key, exp, content_type)
+    if exp < time.time() or not hmac.compare_digest(expected.encode("utf-8"), sig.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="invalid signature")
+    # 同じ key への 2 回目以降の PUT は受け付けない（受信は一時ファイルに書き、最後に link で確定）
+    dest = UPLOAD_INCOMING_DIR / key
+    if dest.exists():
+        raise HTTPException(status_code=409, detail="already uploaded")
+    tmp = UPLOAD_INCOMING_DIR / f".{key}.{uuid.uuid4().hex}.part"
+    try:
+        with tmp.open("xb") as out:
+            async for chunk in request.stream():
+                out.write(chunk)
+        try:
+            os.link(tmp, dest)
+        except FileExistsError:
+            raise HTTPException(status_code=409, detail="already uploaded")
+    finally:
+        tmp.unlink(missing_ok=True)
+    return {"ok": True, "key": key, "size": dest.stat().st_size}
+
+# =========================================================
+# 追加: 音声の取り込み処理（リクエスト外で実行）
+#   ffprobe で長さ・コーデックを調べ、予約スロット長を超えるものは rejected。
+#   それ以外はラウドネス正規化して AAC(.m4a) に変換し、元ファイルと差し替える。
+#   media_status: pending → processing → done / rejected / failed
+#   ※ 同時実行数は AUDIO_WORKERS 本の ffmpeg/ffprobe 子プロセスに制限する
+# =========================================================
+_AUDIO_EXTS = {".wav", ".mp3", ".m4a", ".aac", ".ogg", ".oga", ".opus", ".flac", ".wma", ".aif", ".aiff"}
+_audio_pool = ThreadPoolExecutor(max_workers=max(1, AUDIO_WORKERS), thread_name_prefix="audio")
+
+def _is_audio(mime: Optional[str], name: Optional[str]) -> bool:
+    return (mime or "").startswith("audio/") or Path(name or "").suffix.lower() in _AUDIO_EXTS
+
+def _probe_audio(src: str) -> Dict:
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", src],
+        capture_output=True, check=True, timeout=AUDIO_TIMEOUT_SECONDS,
+    ).stdout
+    info = json.loads(out or b"{}")
+    stream = next((st for st in info.get("streams", []) if st.get("codec_type") == "audio"), None)
+    if stream is None:
+        raise ValueError("no audio stream")
+    fmt = info.get("format", {})
+    return {
+        "duration": float(fmt.get("duration") or stream.get("duration") or 0),
+        "codec": stream.get("codec_name"),
+        "sample_rate": int(stream.get("sample_rate") or 0),
+        "channels": int(stream.get("channels") or 0),
+        "bit_rate": int(fmt.get("bit_rate") or 0),
+        "format": fmt.get("format_name"),
+    }
+
+def _transcode_audio(src: str, dst: str) -> None:
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", src, "-vn",
+         "-af", f"loudnorm={AUDIO_LOUDNORM}", "-ar", "44100", "-ac", "2",
+         "-c:a", "aac", "-b:a", AUDIO_BITRATE, "-movflags", "+faststart", dst],
+        capture_output=True, check=True, timeout=AUDIO_TIMEOUT_SECONDS,
+    )
+
+def _set_audio_status(file_id: int, status: str, error: Optional[str] = None, **cols) -> None:
+    sets = ", ".join(f"{c} = CAST(:{c} AS JSONB)" if c == "media_meta" else f"{c} = :{c}" for c in cols)
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            UPDATE submission_files
+               SET media_status = :st, media_error = :err, media_updated_at = now()
+                   {", " + sets if sets else ""}
+             WHERE id = :id
+        """), {"id": file_id, "st": status, "err": error, **cols})
+
+def process_audio_file(file_id: int) -> None:
+    # 取り合い防止: pending を processing に変えられたワーカーだけが処理する
+    with engine.begin() as conn:
+        row = conn.execute(text("""
+            UPDATE submission_files
+               SET media_status = 'processing', media_updated_at = now()
+             WHERE id = :id AND media_status = 'pending'
+            RETURNING path, size, submission_id
+        """), {"id": file_id}).mappings().first()
+    if not row:
+        return
+
+    src_path = row["path"]
+    try:
+        with storage.local_copy(src_path) as src:
+            meta = _probe_audio(src)
+            meta["original"] = {"path": src_path, "size": row["size"]}
+            # 1 予約 = SLOT_MINUTES 分（recurrence の interval は開始時刻の間隔で枠の長さではない）
+            limit = SLOT_MINUTES * 60
+            if meta["duration"] > limit:
+                _set_audio_status(
+                    file_id, "rejected", f"audio is longer than slot ({meta['duration']:.1f}s > {limit}s)",
+                    duration_sec=meta["duration"], codec=meta["codec"], media_meta=json.dumps(meta),
+                )
+                return
+            with tempfile.TemporaryDirectory() as tmpdir:
+                out = Path(tmpdir) / "out.m4a"
+                _transcode_audio(src, str(out))
+                out_meta = _probe_audio(str(out))
+                with out.open("rb") as fh:
+                    new_path, new_size = storage.save(new_upload_key("out.m4a"), fh, "audio/mp4")
+    except Exception as e:
+        err = e.stderr.decode("utf-8", "replace")[-500:] if isinstance(e, subprocess.CalledProcessError) else str(e)
+        print("audio processing failed:", file_id, err)
+        _set_audio_status(file_id, "failed", err or type(e).__name__)
+        return
+
+    with engine.begin() as conn:
+        # 処理中に承認されることがあるので状態はここで読み直す。
+        # FOR SHARE で承認の UPDATE と直列化し、どちらが先でも再生表に音声が載るようにする
+        status = conn.execute(text("SELECT status FROM submissions WHERE id = :sid FOR SHARE"),
+                              {"sid": row["submission_id"]}).scalar()
+        conn.execute(text("""
+            UPDATE submission_files
+               SET path = :p, mime = 'audio/mp4', size = :sz,
+                   duration_sec = :dur, codec = :codec, media_meta = CAST(:meta AS JSONB),
+                   media_status = 'done', media_error = NULL, media_updated_at = now()
+             WHERE id = :id
+        """), {"id": file_id, "p": new_path, "sz": new_size, "dur": out_meta["duration"],
+               "codec": out_meta["codec"], "meta": json.dumps({**meta, "output": out_meta})})
+        # 承認済みなら再生表に音声を反映
+        if status == "approved":
+            rebuild_manifests_for_submission(conn, int(row["submission_id"]))
+    try:
+        storage.delete(src_path)
+    except Exception as e:
+        print("audio original cleanup failed:", src_path, e)
+
+def enqueue_audio_jobs(file_ids: List[int]) -> None:
+    if not file_ids:
+        return
+    if not (shutil.which("ffprobe") and shutil.which("ffmpeg")):
+        print("ffmpeg/ffprobe not found; audio stays pending:", file_ids)
+        return
+    for fid in file_ids:
+        _audio_pool.submit(process_audio_file, int(fid))
+
+def requeue_audio_jobs() -> None:
+    """起動時: 未処理と、1 時間以上止まっている processing を積み直す"""
+    with engine.begin() as conn:
+        ids = conn.execute(text("""
+            UPDATE submission_files
+               SET media_status = 'pending', media_updated_at = now()
+             WHERE media_status = 'pending'
+                OR (media_status = 'processing' AND media_updated_at < now() - interval '1 hour')
+            RETURNING id
+        """)).scalars().all()
+    enqueue_audio_jobs(list(ids))
+
+@app.get("/api/submissions/{submission_id}/media")
+def get_submission_media(
+    submission_id: int,
+    token: Optional[str] = Query(None, description="申請時に返した media_token"),
+    authorization: Optional[str] = Header(None),
+):
+    # 申請者は media_token、それ以外は管理者のみ
+    if not (token and hmac.compare_digest(token.encode("utf-8"), _media_token(submission_id).encode("utf-8"))):
+        require_admin(authorization)
+    with engine.begin() as conn:
+        rows = conn.execute(text("""
+            SELECT id, original_name, path, mime, size, media_status, media_error, duration_sec, codec
+              FROM submission_files
+             WHERE submission_id = :id
+             ORDER BY id
+        """), {"id": submission_id}).mappings().all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="not found")
+    return {
+        "submission_id": submission_id,
+        "files": [{
+            "id": int(r["id"]),
+            "name": r["original_name"],
+            "url": _file_path_to_url(r["path"]),
+            "mime": r["mime"],
+            "size": r["size"],
+            "status": r["media_status"],
+            "error": r["media_error"],
+            "duration": r["duration_sec"],
+            "codec": r["codec"],
+        } for r in rows],
+    }
+
+# =========================================================
+# 追加: ストレージ照合（孤立ファイルの回収・実体の無い行の検出）
+#   1) ストレージを逐次走査し、猶予より古いものを STORAGE_GC_BATCH_SIZE 件ずつ
+#      submission_files.path と照合 → 行の無いもの（孤立）を report / quarantine / delete
+#   2) submission_files を id 順にページングし、実体の無い行に missing_since を付ける
+#   一覧は保持しないのでファイル数に関係なくメモリは一定。全ワーカーで同時に 1 本だけ走る。
+# =========================================================
+_GC_SAMPLE_LIMIT = 100
+_gc_state: Dict = {"running": False, "last": None}
+
+def _gc_orphan_batch(batch: List[Tuple[str, int, float]], action: str, report: Dict) -> None:
+    # 完全一致ではなく key で照合する（UPLOAD_DIR の書き方が変わっても生きているファイルを孤立扱いしない）
+    with engine.begin() as conn:
+        known = set(conn.execute(text(f"""
+            SELECT {_storage_key_sql("path")} FROM submission_files
+             WHERE {_storage_key_sql("path")} = ANY(:keys)
+        """), {"keys": [_storage_key(b[0]) for b in batch]}).scalars().all())
+    for path, size, _ in batch:
+        if _storage_key(path) in known:
+            continue
+        report["orphans"] += 1
+        report["orphan_bytes"] += size
+        if len(report["orphan_samples"]) < _GC_SAMPLE_LIMIT:
+            report["orphan_samples"].append(path)
+        if action == "report":
+            continue
+        try:
+            if action == "delete":
+                storage.delete(path)
+            else:
+                storage.quarantine(path)
+            report["bytes_reclaimed"] += size
+        except Exception as e:
+            report["errors"] += 1
+            print("storage gc failed:", path, e)
+
+def reconcile_storage(action: str, grace_seconds: int, batch_size: int) -> Dict:
+    report = {
+        "action": action, "started_at": datetime.utcnow().isoformat(), "finished_at": None,
+        "scanned": 0, "skipped_recent": 0, "orphans": 0, "orphan_bytes": 0, "bytes_reclaimed": 0,
+        "errors": 0, "rows_checked": 0, "missing_rows": 0, "orphan_samples": [], "missing_samples": [],
+    }
+    cutoff = time.time() - grace_seconds
+    batch: List[Tuple[str, int, float]] = []
+    for obj in storage.iter_objects():
+        report["scanned"] += 1
+        if obj[2] > cutoff:
+            report["skipped_recent"] += 1
+            continue
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            _gc_orphan_batch(batch, action, report)
+            batch = []
+    if batch:
+        _gc_orphan_batch(batch, action, report)
+
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text("""
+                SELECT id, path, missing_since IS NOT NULL AS flagged
+                  FROM submission_files
+                 WHERE id > :last
+                 ORDER BY id
+                 LIMIT :n
+            """), {"last": last_id, "n": batch_size}).all()
+        if not rows:
+            break
+        last_id = int(rows[-1][0])
+        missing, found_again = [], []
+        for fid, path, flagged in rows:
+            report["rows_checked"] += 1
+            # 今のバックエンドで確かめられない行（local 運用中の s3:// など）は対象外
+            if path.startswith("s3://"):
+                exists = storage.exists(path) if storage is not local_storage else True
+            else:
+                exists = local_storage.exists(path)
+            if exists:
+                if flagged:
+                    found_again.append(int(fid))
+                continue
+            missing.append(int(fid))
+            if len(report["missing_samples"]) < _GC_SAMPLE_LIMIT:
+                report["missing_samples"].append({"id": int(fid), "path": path})
+        report["missing_rows"] += len(missing)
+        if missing or found_again:
+            with engine.begin() as conn:
+                conn.execute(text("""
+                    UPDATE submission_files
+                       SET missing_since = CASE WHEN id = ANY(:missing)
+                                                THEN COALESCE(missing_since, now()) END
+                     WHERE id = ANY(:ids)
+                """), {"missing": missing or [0], "ids": missing + found_again})
+
+    report["finished_at"] = datetime.utcnow().isoformat()
+    return report
+
+def run_storage_reconcile(action: str, grace_seconds: int, batch_size: int) -> Optional[Dict]:
+    """他ワーカーで実行中なら None"""
+    with engine.connect() as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_lock(hashtext('storage_reconcile'))")).scalar():
+            return None
+        _gc_state["running"] = True
+        try:
+            report = reconcile_storage(action, grace_seconds, batch_size)
+            _gc_state["last"] = report
+            return report
+        except Exception as e:
+            print("storage reconcile failed:", e)
+            _gc_state["last"] = {"action": action, "error": str(e)}
+            return None
+        finally:
+            _gc_state["running"] = False
+            lock_conn.execute(text("SELECT pg_advisory_unlock(hashtext('storage_reconcile'))"))
+            lock_conn.commit()
+
+def _storage_gc_loop() -> None:
+    while True:
+        time.sleep(STORAGE_GC_INTERVAL_SECONDS)
+        run_storage_reconcile(STORAGE_GC_ACTION, STORAGE_GC_GRACE_SECONDS, STORAGE_GC_BATCH_SIZE)
+
+@app.post("/api/admin/storage/reconcile", status_code=202)
+def start_storage_reconcile(
+    action: str = Query("report", description="report / quarantine / delete"),
+    grace_seconds: int = Query(STORAGE_GC_GRACE_SECONDS, ge=0),
+    batch_size: int = Query(STORAGE_GC_BATCH_SIZE, ge=1, le=10000),
+    claims=Depends(require_admin),
+):
+    if action not in ("report", "quarantine", "delete"):
+        raise HTTPException(status_code=400, detail="invalid action")
+    if _gc_state["running"]:
+        raise HTTPException(status_code=409, detail="already running")
+    threading.Thread(
+        target=run_storage_reconcile, args=(action, grace_seconds, batch_size),
+        name="storage-gc", daemon=True,
+    ).start()
+    return {"ok": True, "started": True}
+
+@app.get("/api/admin/storage/reconcile")
+def get_storage_reconcile(claims=Depends(require_admin)):
+    return {"running": _gc_state["running"], "last": _gc_state["last"]}
+
+# =========================================================
+# 追加: 文字入れ済み画像のサーバ側合成（審査画面・端末向け）
+#   先頭ファイルに overlay / lines / caption 等をフロントの TextOverlay と同じ配置で描く。
+#   キーは _render_key_sql（描画に効く列のハッシュ）。合成はプロセスプールで行い、
+#   RENDER_CACHE_DIR に保存。参照のたびに mtime を更新し、上限超過時は古い順に削除（LRU）。
+# =========================================================
+_render_proc_pool: Optional[ProcessPoolExecutor] = None
+_render_dispatch = ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS), thread_name_prefix="render")
+_render_inflight: Dict[str, Future] = {}
+_render_lock = threading.Lock()
+# 失敗したキー -> 再試行してよい時刻（壊れた画像で毎回プロセスを回さない）
+_render_failed: "OrderedDict[str, float]" = OrderedDict()
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_proc_pool
+    with _render_lock:
+        if _render_proc_pool is None:
+            # fork だと LISTEN / 音声スレッドや DB プールのロックを持ったまま複製されて固まりうるので spawn
+            _render_proc_pool = ProcessPoolExecutor(max_workers=max(1, RENDER_WORKERS),
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        return _render_proc_pool
+
+_font_cache: Dict[Tuple[int, bool], object] = {}
+
+def _render_font(size: int, bold: bool):
+    from PIL import ImageFont
+
+    key = (size, bold)
+    if key not in _font_cache:
+        path = RENDER_FONT_BOLD_PATH if bold else RENDER_FONT_PATH
+        try:
+            _font_cache[key] = ImageFont.truetype(path, size)
+        except OSError:
+            try:
+                _font_cache[key] = ImageFont.load_default(size)
+            except TypeError:
+                _font_cache[key] = ImageFont.load_default()
+    return _font_cache[key]
+
+def _render_color(v: Optional[str]) -> Tuple[int, int, int]:
+    from PIL import ImageColor
+
+    try:
+        return ImageColor.getrgb(v or "#ffffff")[:3]
+    except ValueError:
+        return (255, 255, 255)
+
+def _wrap_text(draw, text_: str, font, width: float) -> List[str]:
+    """語の区切りが無い日本語もあるので 1 文字ずつ幅を測って折り返す"""
+    out, cur = [], ""
+    for ch in text_:
+        if cur and draw.textlength(cur + ch, font=font) > width:
+            out.append(cur)
+            cur = ch
+        else:
+            cur += ch
+    out.append(cur)
+    return out
+
+def _draw_text_box(draw, rows: List[Tuple[str, int, bool]], box, align: str, valign: str, color) -> None:
+    """rows = [(テキスト, px, 太字)]。box = (x, y, w, h)。はみ出た行は描かない"""
+    x, y, w, h = box
+    laid = []
+    for txt, size, bold in rows:
+        font = _render_font(size, bold)
+        for ln in _wrap_text(draw, txt, font, w):
+            laid.append((ln, font, int(size * 1.25)))
+    total = sum(lh for _, _, lh in laid)
+    top = y + (h - total) / 2 if valign == "middle" else y + h - total if valign == "bottom" else y
+    cy = max(top, y)
+    for ln, font, lh in laid:
+        if cy + lh > y + h + 1:
+            break
+        tw = draw.textlength(ln, font=font)
+        cx = x + (w - tw) / 2 if align == "center" else x + w - tw if align == "right" else x
+        draw.text((cx + 1, cy + 1), ln, font=font, fill=(0, 0, 0, 90))
+        draw.text((cx, cy), ln, font=font, fill=color + (255,))
+        cy += lh
+
+def _render_frame(src: str, dst: str, spec: Dict) -> None:
+    """プロセスプール側で実行。src の画像に文字を合成して dst（JPEG）に書く"""
+    from PIL import Image, ImageDraw, ImageOps
+
+    img = ImageOps.exif_transpose(Image.open(src)).convert("RGBA")
+    if img.width > RENDER_MAX_WIDTH:
+        img = img.resize((RENDER_MAX_WIDTH, round(img.height * RENDER_MAX_WIDTH / img.width)))
+    W, H = img.size
+    scale = W / RENDER_BASE_WIDTH
+    layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+
+    overlay = spec.get("overlay") if isinstance(spec.get("overlay"), dict) else {}
+    boxes, values = overlay.get("textBoxes"), overlay.get("values")
+    if isinstance(boxes, list) and isinstance(values, dict):
+        for tb in boxes:
+            if not isinstance(tb, dict):
+                continue
+            value = str(values.get(tb.get("key")) or "")
+            if not value:
+                continue
+            size = max(10, round((tb.get("fontSize") or 24) * scale))
+            bold = (tb.get("weight") or 700) >= 600
+            lines = value.splitlines()
+            if (tb.get("lines") or 0) > 0:
+                lines = lines[: tb["lines"]]
+            box = (W * (tb.get("x") or 0) / 100, H * (tb.get("y") or 0) / 100,
+                   W * (tb.get("w") or 100) / 100, H * (tb.get("h") or 100) / 100)
+            _draw_text_box(draw, [(ln, size, bold) for ln in lines], box,
+                           tb.get("align") or "left", tb.get("valign") or "top",
+                           _render_color(tb.get("color") or spec.get("text_color")))
+    else:
+        # overlay の無い旧データ: title / message / caption / lines を下寄せ中央に
+        texts = [t for t in (spec.get("title"), spec.get("message"), spec.get("caption")) if t]
+        texts += [str(x) for x in (spec.get("lines") or [])]
+        base = 28 * scale
+        rows = [(t, max(10, round(base * (1 - i * 0.08))), i == 0) for i, t in enumerate(texts[:5])]
+        if rows:
+            _draw_text_box(draw, rows, (W * 0.05, 0, W * 0.9, H * 0.94), "center", "bottom",
+                           _render_color(spec.get("text_color")))
+
+    Image.alpha_composite(img, layer).convert("RGB").save(dst, "JPEG", quality=90)
+
+def _evict_render_cache() -> None:
+    entries = []
+    total = 0
+    with os.scandir(RENDER_CACHE_DIR) as it:
+        for e in it:
+            if e.is_file() and e.name.endswith(".jpg"):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    if total <= RENDER_CACHE_MAX_BYTES:
+        return
+    # 上限の 9 割まで古い順に消す
+    for _, size, path in sorted(entries):
+        if total <= RENDER_CACHE_MAX_BYTES * 0.9:
+            break
+        Path(path).unlink(missing_ok=True)
+        total -= size
+
+def _render_now(submission_id: int) -> Optional[str]:
+    """現在の内容で合成してキーを返す（画像が無ければ None）"""
+    with engine.begin() as conn:
+        r = conn.execute(text(_SUBMISSION_OUT_SQL + " WHERE s.id = :id"),
+                         {"id": submission_id}).mappings().first()
+    if not r or not r["image_path"]:
+        return None
+    key = r["render_key"]
+    dest = RENDER_CACHE_DIR / f"{key}.jpg"
+    if dest.exists():
+        return key
+    spec = {
+        "overlay": r["overlay"], "lines": r["lines"] if isinstance(r["lines"], list) else None,
+        "text_color": r["text_color"], "title": r["title"], "message": r["message"], "caption": r["caption"],
+    }
+    tmp = RENDER_CACHE_DIR / f".{key}.{uuid.uuid4().hex}.tmp"
+    try:
+        with storage.local_copy(r["image_path"]) as src:
+            _get_render_pool().submit(_render_frame, src, str(tmp), spec).result()
+        os.replace(tmp, dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+    _evict_render_cache()
+    return key
+
+def ensure_rendered(submission_id: int) -> Optional[str]:
+    """同じ申請の合成が並行したら 1 本にまとめる"""
+    with _render_lock:
+        fut = _render_inflight.get(str(submission_id))
+        if fut is None:
+            fut = _render_dispatch.submit(_render_now, submission_id)
+            _render_inflight[str(submission_id)] = fut
+            fut.add_done_callback(lambda _f: _render_inflight.pop(str(submission_id), None))
+    return fut.result()
+
+def prewarm_render(submission_id: int) -> None:
+    def _run():
+        try:
+            ensure_rendered(submission_id)
+        except Exception as e:
+            print("render prewarm failed:", submission_id, e)
+    threading.Thread(target=_run, name="render-prewarm", daemon=True).start()
+
+@app.get("/api/render/{submission_id}/{filename}")
+async def get_rendered_frame(submission_id: int, filename: str):
+    key = filename.removesuffix(".jpg")
+    if not re.match(r"^[0-9a-f]{32}$", key):
+        raise HTTPException(status_code=404, detail="not found")
+    dest = RENDER_CACHE_DIR / f"{key}.jpg"
+    if not dest.exists():
+        retry_at = _render_failed.get(key)
+        if retry_at and retry_at > time.monotonic():
+            raise HTTPException(status_code=503, detail="render failed",
+                                headers={"Retry-After": str(int(retry_at - time.monotonic()) + 1)})
+        try:
+            current = await run_in_threadpool(ensure_rendered, submission_id)
+        except Exception as e:
+            print("render failed:", submission_id, e)
+            with _render_lock:
+                _render_failed[key] = time.monotonic() + RENDER_FAIL_RETRY_SECONDS
+                _render_failed.move_to_end(key)
+                while len(_render_failed) > 1024:
+                    _render_failed.popitem(last=False)
+            raise HTTPException(status_code=503, detail="render failed",
+                                headers={"Retry-After": str(RENDER_FAIL_RETRY_SECONDS)})
+        if current is None:
+            raise HTTPException(status_code=404, detail="not found")
+        if current != key:
+            # 内容が変わって古いキーになっている
+            return RedirectResponse(_rendered_url(submission_id, current), status_code=307)
+    try:
+        os.utime(dest)  # LRU 用に最終参照を更新
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="not found")
+    return FileResponse(dest, media_type="image/jpeg",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
@@ -0,0 +1,126 @@
+"""
+空き枠検索（/api/truck/available の SQL）のベンチマークと実行計画
+
+  1 年分・営業時間いっぱいの枠を --density の割合で埋めた kind を 1 トランザクション内に作り
+  （最後にロールバックするので DB には残らない）、代表的な問い合わせを
+  repeat 回ずつ流して最良値を出す。各問い合わせの EXPLAIN (ANALYZE, BUFFERS) も表示し、
+  reservation_slots を Seq Scan していたら NG（PK (kind, day, time) の範囲探索であること）。
+  結果は Python で求めた空き枠とも突き合わせる。
+
+使い方（DATABASE_URL は app.py と同じ）:
+  python app/scripts/bench_available_slots.py [--days 366] [--density 0.9] [--repeat 5] [--quiet-plans]
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import text  # noqa: E402
+
+import app as appmod  # noqa: E402
+
+KIND = "bench-available"
+START = date(2030, 1, 1)
+
+def seed(conn, days: int, density: float, seed_: int) -> set:
+    rnd = random.Random(seed_)
+    sid = conn.execute(text("""
+        INSERT INTO submissions(kind, title, schedule_json, status)
+        VALUES (:k, 'bench', '{}'::jsonb, 'approved')
+        RETURNING id
+    """), {"k": KIND}).scalar_one()
+    booked = set()
+    per_day = range(appmod.OPEN_HOUR * 60, appmod.CLOSE_HOUR * 60, appmod.SLOT_MINUTES)
+    for i in range(days):
+        d = START + timedelta(days=i)
+        for m in per_day:
+            if rnd.random() < density:
+                booked.add((d.isoformat(), f"{m // 60:02d}:{m % 60:02d}"))
+    items = sorted(booked)
+    for off in range(0, len(items), appmod.SLOT_CHUNK_SIZE):
+        chunk = items[off:off + appmod.SLOT_CHUNK_SIZE]
+        conn.execute(text("""
+            INSERT INTO reservation_slots(kind, day, time, submission_id)
+            SELECT :k, x.day, x.time, :sid
+              FROM unnest(CAST(:days AS date[]), CAST(:times AS time[])) AS x(day, time)
+        """), {"k": KIND, "sid": sid, "days": [d for d, _ in chunk], "times": [t for _, t in chunk]})
+    conn.execute(text("ANALYZE reservation_slots"))
+    return booked
+
+def expected(booked: set, s: date, e: date, m_from: int, m_to: int, step: int, limit: int):
+    out = []
+    d = s
+    while d <= e and len(out) < limit:
+        for m in range(m_from, m_from + ((m_to - m_from) // step) * step, step):
+            sub = {f"{x // 60:02d}:{x % 60:02d}" for x in range(m, m + step, appmod.SLOT_MINUTES)}
+            if not any((d.isoformat(), t) in booked for t in sub):
+                out.append((d.isoformat(), f"{m // 60:02d}:{m % 60:02d}"))
+                if len(out) >= limit:
+                    break
+        d += timedelta(days=1)
+    return out
+
+def params(s: date, e: date, m_from: int, m_to: int, step: int, limit: int):
+    return {"s": s, "e": e, "k": KIND, "m_from": m_from, "step": step,
+            "n": (m_to - m_from) // step, "lim": limit + 1}
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--days", type=int, default=366)
+    ap.add_argument("--density", type=float, default=0.9)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--quiet-plans", action="store_true")
+    args = ap.parse_args()
+
+    end = START + timedelta(days=args.days - 1)
+    cases = [
+        # (名前, start, end, from, to, step, limit)
+        ("next 30, full day, 1 year", START, end, appmod.OPEN_HOUR * 60, appmod.CLOSE_HOUR * 60, 30, 30),
+        ("next 30, 18-21h, 1 week", START + timedelta(days=7), START + timedelta(days=13), 18 * 60, 21 * 60, 30, 30),
+        ("next 30, 18-21h, 1 year", START, end, 18 * 60, 21 * 60, 30, 30),
+        ("next 10 x 60min, 1 year", START, end, appmod.OPEN_HOUR * 60, appmod.CLOSE_HOUR * 60, 60, 10),
+        ("1000 free, full day, 1 year", START, end, appmod.OPEN_HOUR * 60, appmod.CLOSE_HOUR * 60, 30, 1000),
+    ]
+
+    ok = True
+    with appmod.engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            t0 = time.perf_counter()
+            booked = seed(conn, args.days, args.density, args.seed)
+            print(f"seeded {len(booked)} booked slots over {args.days} days "
+                  f"(density {args.density}) in {time.perf_counter() - t0:.1f}s\n")
+            print(f"{'case':32} {'candidates':>10} {'best ms':>9} {'rows':>5}  result  plan")
+            for name, s, e, m_from, m_to, step, limit in cases:
+                p = params(s, e, m_from, m_to, step, limit)
+                best = None
+                rows = []
+                for _ in range(args.repeat):
+                    t1 = time.perf_counter()
+                    rows = conn.execute(text(appmod._AVAILABLE_SLOTS_SQL), p).all()
+                    dt = time.perf_counter() - t1
+                    best = dt if best is None else min(best, dt)
+                got = [(r[0], r[1]) for r in rows[:limit]]
+                same = got == expected(booked, s, e, m_from, m_to, step, limit)
+                plan = [r[0] for r in conn.execute(
+                    text("EXPLAIN (ANALYZE, BUFFERS) " + appmod._AVAILABLE_SLOTS_SQL), p).all()]
+                seq = any("Seq Scan on reservation_slots" in ln for ln in plan)
+                pk = any("reservation_slots_pkey" in ln for ln in plan)
+                good = same and pk and not seq
+                ok = ok and good
+                cands = ((e - s).days + 1) * p["n"]
+                print(f"{name:32} {cands:>10} {best * 1000:>9.2f} {len(got):>5}  "
+                      f"{'OK' if same else 'NG':6}  {'pk probe' if pk and not seq else 'NG seq scan'}")
+                if not args.quiet_plans:
+                    print("    " + "\n    ".join(plan) + "\n")
+        finally:
+            trans.rollback()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
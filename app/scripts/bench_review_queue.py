@@ -0,0 +1,143 @@
+"""
+審査キュー一覧: 通常モード（行→SubmissionOut→response_model で JSON 化）と
+fast=true（Postgres の json_agg をそのまま返す）の速度比較と出力の突き合わせ
+
+  件数ごとに申請を投入し（1 トランザクション内で行い最後にロールバックするので DB には残らない）、
+  両経路を repeat 回ずつ計測して最良値を出す。JSON として比較し、1 件でも違えば終了コード 1。
+  投入データには空の会社名、数値/null/真偽値を含む lines、配列でない lines、overlay、
+  マイクロ秒 0 / 末尾ゼロの created_at、音声・S3 のファイルを混ぜる。
+
+使い方（DATABASE_URL は app.py と同じ）:
+  python app/scripts/bench_review_queue.py [--sizes 1000,10000,50000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+import app as appmod  # noqa: E402
+
+BENCH_STATUS = "bench"
+
+LINES_SAMPLES = [
+    json.dumps(["一行目", "二行目"], ensure_ascii=False),
+    json.dumps(["a", 1, None, True, {"k": "v"}]),
+    json.dumps("not an array"),
+    None,
+]
+OVERLAY_SAMPLE = json.dumps({
+    "textBoxes": [{"key": "title", "x": 10, "y": 70, "w": 80, "h": 20, "fontSize": 32}],
+    "values": {"title": "見出し"},
+}, ensure_ascii=False)
+
+def _response_field():
+    for r in appmod.app.routes:
+        if getattr(r, "path", None) == "/api/admin/review/queue":
+            return r.response_field
+    raise RuntimeError("review queue route not found")
+
+def seed(conn, n: int) -> None:
+    conn.execute(text("""
+        INSERT INTO submissions(kind, title, schedule_json, status, company_name,
+                                message, caption, text_color, lines, overlay, created_at)
+        SELECT 'bench', 'title ' || g, '{}'::jsonb, :st,
+               CASE WHEN g % 5 = 0 THEN '' ELSE '会社 ' || g END,
+               CASE WHEN g % 2 = 0 THEN 'メッセージ ' || g END,
+               CASE WHEN g % 3 = 0 THEN 'caption' END,
+               '#ffffff',
+               CAST((CAST(:lines AS text[]))[1 + g % 4] AS JSONB),
+               CASE WHEN g % 3 = 0 THEN CAST(:overlay AS JSONB) END,
+               -- 秒ちょうど / .5 / .500010 のように isoformat の表記が変わる値を混ぜる
+               TIMESTAMPTZ '2024-01-01 00:00:00+00' + g * INTERVAL '500 milliseconds'
+                 + (g % 3) * INTERVAL '10 microseconds'
+          FROM generate_series(1, :n) AS g
+    """), {"st": BENCH_STATUS, "n": n, "lines": LINES_SAMPLES, "overlay": OVERLAY_SAMPLE})
+    conn.execute(text("""
+        INSERT INTO submission_files(submission_id, path, original_name, mime, size)
+        SELECT s.id,
+               CASE WHEN f = 1 AND s.id % 7 = 0 THEN './uploads/' || s.id || '.mp3'
+                    WHEN s.id % 11 = 0 THEN 's3://bench-bucket/uploads/' || s.id || '_' || f || '.png'
+                    ELSE './uploads/' || s.id || '_' || f || '.png' END,
+               'file' || f,
+               CASE WHEN f = 1 AND s.id % 7 = 0 THEN 'audio/mpeg' ELSE 'image/png' END,
+               1000
+          FROM submissions s
+          CROSS JOIN LATERAL generate_series(1, (s.id % 3)::int) AS f
+         WHERE s.status = :st
+    """), {"st": BENCH_STATUS})
+    conn.execute(text("ANALYZE submissions"))
+    conn.execute(text("ANALYZE submission_files"))
+
+def run_model_path(conn, field) -> bytes:
+    rows = conn.execute(text(appmod._SUBMISSION_OUT_SQL + """
+         WHERE s.status = :st
+         ORDER BY s.created_at DESC, s.id DESC
+    """), {"st": BENCH_STATUS}).mappings().all()
+    outs = [appmod._submission_row_to_out(r) for r in rows]
+    content = asyncio.run(serialize_response(field=field, response_content=outs, is_coroutine=False))
+    return JSONResponse(content).body
+
+def run_fast_path(conn) -> bytes:
+    body = conn.execute(text(appmod._SUBMISSION_OUT_JSON_SQL),
+                        {"st": BENCH_STATUS, **appmod._file_url_params()}).scalar_one()
+    return body.encode()
+
+def best_of(fn, repeat: int):
+    best, out = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+def compare(a: bytes, b: bytes) -> bool:
+    ja, jb = json.loads(a), json.loads(b)
+    if ja == jb:
+        return True
+    if len(ja) != len(jb):
+        print(f"  NG length differs: model={len(ja)} fast={len(jb)}")
+        return False
+    for x, y in zip(ja, jb):
+        if x != y:
+            keys = sorted(k for k in set(x) | set(y) if x.get(k) != y.get(k))
+            print(f"  NG id={x.get('id')} differs in {keys}")
+            for k in keys[:5]:
+                print(f"     {k}: model={x.get(k)!r} fast={y.get(k)!r}")
+            break
+    return False
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,10000,50000")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    field = _response_field()
+    ok = True
+    print(f"{'rows':>8} {'model ms':>10} {'fast ms':>10} {'speedup':>8} {'bytes':>10}  match")
+    for n in [int(x) for x in args.sizes.split(",") if x]:
+        with appmod.engine.connect() as conn:
+            trans = conn.begin()
+            try:
+                seed(conn, n)
+                t_model, body_model = best_of(lambda: run_model_path(conn, field), args.repeat)
+                t_fast, body_fast = best_of(lambda: run_fast_path(conn), args.repeat)
+                same = compare(body_model, body_fast)
+                ok = ok and same
+                print(f"{n:>8} {t_model * 1000:>10.1f} {t_fast * 1000:>10.1f} "
+                      f"{t_model / t_fast:>7.1f}x {len(body_fast):>10}  {'OK' if same else 'NG'}")
+            finally:
+                trans.rollback()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+/api/admin/export の定メモリ確認（100 万行）と、途中失敗時に正常終了しないことの確認
+
+  1) reservation_slots に --rows 件（既定 100 万）を投入してコミットする。
+     枠は kind = 'export-check-NN'、2099 年の日付に置き、紐づく申請（kind = 'export-check'）も作る。
+     使い捨ての DB で実行すること。終了時に投入分は削除する。
+  2) table=reservation_slots を csv / ndjson / csv+gzip でプロセス内で最後まで読み、
+     読み出し中の RSS（/proc/self/statm）の増分の最大値と、出力行数を確認する。
+     増分が --max-growth-mb を超えるか行数が合わなければ NG。
+  3) 読み出しの途中で COPY のバックエンドを pg_terminate_backend で落とし、
+     ボディのジェネレータが ExportFailed を送出する（= 正常終了しない）ことを確認する。
+
+使い方（DATABASE_URL は app.py と同じ）:
+  python app/scripts/check_export_rss.py [--rows 1000000] [--max-growth-mb 64] [--keep]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import text  # noqa: E402
+
+import app as appmod  # noqa: E402
+
+KIND = "export-check"
+SUBMISSIONS = 1000
+# 1 kind あたり 365 日 × 48 枠（30 分刻み 24 時間）
+SLOT_DAYS = 365
+SLOTS_PER_DAY = 48
+PAGE = os.sysconf("SC_PAGE_SIZE")
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE
+
+def cleanup() -> None:
+    # 枠は ON DELETE CASCADE で消える。kind が同じで別の申請に付いた枠は残さない
+    with appmod.engine.begin() as conn:
+        conn.execute(text("DELETE FROM reservation_slots WHERE kind LIKE :p"), {"p": KIND + "-%"})
+        conn.execute(text("DELETE FROM submissions WHERE kind = :k"), {"k": KIND})
+
+def seed(rows: int) -> None:
+    cleanup()
+    with appmod.engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO submissions(kind, title, schedule_json, status, company_name,
+                                    message, caption, text_color, lines, overlay)
+            SELECT :k, 'title ' || g, '{}'::jsonb,
+                   (ARRAY['pending', 'approved', 'rejected'])[1 + g % 3],
+                   '会社 ' || (g % 1000),
+                   'メッセージ', 'caption ' || g, '#ffffff',
+                   jsonb_build_array('一行目 ' || g), '{}'::jsonb
+              FROM generate_series(1, :n) AS g
+        """), {"k": KIND, "n": SUBMISSIONS})
+        # g を (kind 番号, 日, 枠) に割り当てるので (kind, day, time) は重ならない
+        conn.execute(text("""
+            WITH subs AS (SELECT array_agg(id ORDER BY id) AS ids FROM submissions WHERE kind = :k)
+            INSERT INTO reservation_slots(kind, day, time, submission_id)
+            SELECT :k || '-' || (g / (:days * :per_day))::text,
+                   DATE '2099-01-01' + (g / :per_day) % :days,
+                   TIME '00:00' + make_interval(mins => (g % :per_day) * 30),
+                   subs.ids[1 + g % cardinality(subs.ids)]
+              FROM subs, generate_series(0, :n - 1) AS g
+        """), {"k": KIND, "n": rows, "days": SLOT_DAYS, "per_day": SLOTS_PER_DAY})
+
+def export_response(fmt: str, gz: bool):
+    return appmod.admin_export(table="reservation_slots", format=fmt, start=None, end=None,
+                               status=None, gzip=gz, claims=None)
+
+async def drain(resp, on_chunk=None):
+    """ボディを最後まで読み、(出力バイト数, 改行数, RSS 増分の最大値) を返す"""
+    base = rss_bytes()
+    peak = 0
+    total = 0
+    newlines = 0
+    dz = None
+    n = 0
+    async for chunk in resp.body_iterator:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        total += len(chunk)
+        if resp.media_type == "application/gzip":
+            dz = dz or zlib.decompressobj(31)
+            newlines += dz.decompress(chunk).count(b"\n")
+        else:
+            newlines += chunk.count(b"\n")
+        n += 1
+        if n % 64 == 0:
+            peak = max(peak, rss_bytes() - base)
+        if on_chunk is not None:
+            on_chunk(n)
+    peak = max(peak, rss_bytes() - base)
+    return total, newlines, peak
+
+def check_constant_memory(rows: int, max_growth: int) -> bool:
+    ok = True
+    for fmt, gz in (("csv", False), ("ndjson", False), ("csv", True)):
+        t0 = time.perf_counter()
+        total, newlines, peak = asyncio.run(drain(export_response(fmt, gz)))
+        dt = time.perf_counter() - t0
+        # ほかの枠が残っている DB でも、少なくとも投入分は出ていること
+        expect = rows + (1 if fmt == "csv" else 0)
+        good = newlines >= expect and peak <= max_growth
+        ok = ok and good
+        print(f"{'OK' if good else 'NG'} {fmt}{'+gzip' if gz else '':5} rows>={expect}: lines={newlines} "
+              f"bytes={total / 1e6:.1f}MB rss_growth={peak / 1e6:.1f}MB time={dt:.1f}s")
+    return ok
+
+def check_failure_is_not_clean() -> bool:
+    """途中で COPY のバックエンドを落とすと、ボディが例外で終わること"""
+    killed = {"done": False}
+
+    def kill_copy(n: int) -> None:
+        if killed["done"] or n < 4:
+            return
+        with appmod.engine.begin() as conn:
+            conn.execute(text("""
+                SELECT pg_terminate_backend(pid)
+                  FROM pg_stat_activity
+                 WHERE pid <> pg_backend_pid() AND query LIKE 'COPY (%'
+            """))
+        killed["done"] = True
+
+    try:
+        asyncio.run(drain(export_response("csv", False), kill_copy))
+    except appmod.ExportFailed as e:
+        print(f"OK failure mid-COPY aborts the body: {e}".strip())
+        return True
+    print("NG export finished cleanly although COPY was terminated"
+          + ("" if killed["done"] else " (export ended before the kill; use more --rows)"))
+    return False
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--max-growth-mb", type=float, default=64)
+    ap.add_argument("--keep", action="store_true", help="投入したデータを消さない")
+    args = ap.parse_args()
+
+    print(f"seeding {args.rows} reservation_slots (kind={KIND}-NN) ...")
+    seed(args.rows)
+    try:
+        ok = check_constant_memory(args.rows, int(args.max_growth_mb * 1e6))
+        ok = check_failure_is_not_clean() and ok
+    finally:
+        if not args.keep:
+            cleanup()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+schedule_json と reservation_slots / submission_schedules の同値性チェック
+
+  1) 使い捨てスキーマに乱数の申請を作り、BACKFILL_SLOTS_SQL の結果を
+     旧 Python ループ（全申請を id 順に ON CONFLICT DO NOTHING）の結果と突き合わせる。
+     壊れた JSON・重複・他申請との衝突・一部だけ登録済みの申請も含む。2 回流して冪等性も確認。
+  2) submission_schedules ビューが reservation_slots の集約と一致するか確認。
+  3) --live なら実 DB の schedule_json（recurrence でない申請）と reservation_slots を照合して件数を出す。
+
+使い方（DATABASE_URL は app.py と同じ）:
+  python app/scripts/check_schedule_equivalence.py [--submissions 2000] [--seed 1] [--live]
+"""
+import argparse
+import json
+import random
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import text  # noqa: E402
+
+import app as appmod  # noqa: E402
+
+SCHEMA = "schedule_equivalence_check"
+
+def _rand_schedule(rnd: random.Random):
+    """旧データにありがちな形を混ぜた schedule_json"""
+    roll = rnd.random()
+    if roll < 0.03:
+        return rnd.choice([[], "2024-01-01", None, 1])
+    sched = {}
+    for _ in range(rnd.randint(0, 4)):
+        day = f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+        if rnd.random() < 0.05:
+            sched[day] = rnd.choice(["08:00", {"08:00": 1}, None])
+            continue
+        times = []
+        for _ in range(rnd.randint(0, 6)):
+            r = rnd.random()
+            if r < 0.05:
+                times.append(rnd.choice(["8:00", "08:00:00", "0800", 800, None, ["08:00"], "08-00"]))
+            else:
+                times.append(f"{rnd.randint(8, 22):02d}:{rnd.choice(['00', '30'])}")
+        if times and rnd.random() < 0.1:
+            times.append(times[0])  # 同一申請内の重複
+        sched[day] = times
+    return sched
+
+def _reference_backfill(subs, existing):
+    """旧実装（Python ループ）と同じ規則で (kind, day, time) → submission_id を求める"""
+    taken = dict(existing)
+    for sid, kind, sched in subs:
+        if not isinstance(sched, dict):
+            continue
+        for d, arr in sched.items():
+            if not isinstance(arr, list):
+                continue
+            for t in arr:
+                if isinstance(t, str) and len(t) == 5 and t[2] == ":":
+                    taken.setdefault((kind, d, t), sid)
+    return taken
+
+def _slots(conn):
+    rows = conn.execute(text(
+        "SELECT kind, day::text AS d, to_char(time, 'HH24:MI') AS t, submission_id FROM reservation_slots"
+    )).all()
+    return {(r[0], r[1], r[2]): int(r[3]) for r in rows}
+
+def check_backfill(n: int, seed: int) -> bool:
+    rnd = random.Random(seed)
+    subs = [(i, rnd.choice(["truck", "vision", "x"]), _rand_schedule(rnd)) for i in range(1, n + 1)]
+
+    with appmod.engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+            conn.execute(text(f"SET LOCAL search_path TO {SCHEMA}"))
+            conn.execute(text("""
+                CREATE TABLE submissions (
+                  id BIGINT PRIMARY KEY,
+                  kind VARCHAR(20) NOT NULL,
+                  schedule_json JSONB NOT NULL
+                )
+            """))
+            conn.execute(text("""
+                CREATE TABLE reservation_slots (
+                  kind VARCHAR(20) NOT NULL,
+                  day  DATE NOT NULL,
+                  time TIME NOT NULL,
+                  submission_id BIGINT NOT NULL REFERENCES submissions(id) ON DELETE CASCADE,
+                  created_at TIMESTAMPTZ DEFAULT now(),
+                  PRIMARY KEY (kind, day, time)
+                )
+            """))
+            conn.execute(text(appmod.SUBMISSION_SCHEDULES_VIEW_SQL))
+            conn.execute(
+                text("INSERT INTO submissions(id, kind, schedule_json) VALUES (:id, :k, CAST(:s AS JSONB))"),
+                [{"id": sid, "k": k, "s": json.dumps(sc)} for sid, k, sc in subs],
+            )
+
+            # 一部だけ登録済みの申請（旧バックフィルが途中で止まった状態）を作る
+            expected_all = _reference_backfill(subs, {})
+            existing = {}
+            for key, sid in expected_all.items():
+                if rnd.random() < 0.2:
+                    existing[key] = sid
+            if existing:
+                conn.execute(text("""
+                    INSERT INTO reservation_slots(kind, day, time, submission_id)
+                    VALUES (:k, CAST(:d AS DATE), CAST(:t AS TIME), :sid)
+                """), [{"k": k, "d": d, "t": t, "sid": sid} for (k, d, t), sid in existing.items()])
+
+            expected = _reference_backfill(subs, existing)
+            conn.execute(text(appmod.BACKFILL_SLOTS_SQL))
+            got = _slots(conn)
+            conn.execute(text(appmod.BACKFILL_SLOTS_SQL))
+            again = _slots(conn)
+
+            ok = True
+            if got != expected:
+                ok = False
+                missing = set(expected.items()) - set(got.items())
+                extra = set(got.items()) - set(expected.items())
+                print(f"NG backfill: missing={len(missing)} extra={len(extra)}")
+                for x in sorted(missing)[:5]:
+                    print("  missing", x)
+                for x in sorted(extra)[:5]:
+                    print("  extra  ", x)
+            if again != got:
+                ok = False
+                print("NG backfill is not idempotent")
+
+            ok = check_view(conn) and ok
+            print(f"{'OK' if ok else 'NG'} backfill: submissions={n} slots={len(got)} preexisting={len(existing)}")
+            return ok
+        finally:
+            trans.rollback()
+
+def check_view(conn) -> bool:
+    want = defaultdict(lambda: defaultdict(list))
+    for (_, d, t), sid in sorted(_slots(conn).items(), key=lambda x: (x[1], x[0][1], x[0][2])):
+        want[sid][d].append(t)
+    got = {
+        int(r[0]): r[1]
+        for r in conn.execute(text("SELECT submission_id, schedule FROM submission_schedules")).all()
+    }
+    want = {sid: {d: ts for d, ts in days.items()} for sid, days in want.items()}
+    if got != want:
+        diff = [sid for sid in set(got) | set(want) if got.get(sid) != want.get(sid)]
+        print(f"NG submission_schedules: {len(diff)} submissions differ, e.g. {sorted(diff)[:5]}")
+        return False
+    print(f"OK submission_schedules: {len(got)} submissions")
+    return True
+
+def check_live() -> bool:
+    """実データ: recurrence でない申請の schedule_json の各スロットが reservation_slots にあるか、
+    またその申請のスロットが schedule_json の範囲に収まっているか"""
+    with appmod.engine_ro.begin() as conn:
+        r = conn.execute(text("""
+            WITH js AS (
+              SELECT s.id, s.kind, d.key::date AS day, (t.value #>> '{}')::time AS time
+                FROM submissions s
+                CROSS JOIN LATERAL jsonb_each(
+                  CASE WHEN jsonb_typeof(s.schedule_json) = 'object' THEN s.schedule_json ELSE '{}'::jsonb END
+                ) d
+                CROSS JOIN LATERAL jsonb_array_elements(
+                  CASE WHEN jsonb_typeof(d.value) = 'array' THEN d.value ELSE '[]'::jsonb END
+                ) t
+               WHERE s.schedule_rule IS NULL
+                 AND jsonb_typeof(t.value) = 'string'
+                 AND length(t.value #>> '{}') = 5 AND substr(t.value #>> '{}', 3, 1) = ':'
+            )
+            SELECT
+              (SELECT count(*) FROM js
+                WHERE NOT EXISTS (SELECT 1 FROM reservation_slots rs
+                                   WHERE rs.kind = js.kind AND rs.day = js.day AND rs.time = js.time)
+              ) AS json_without_slot,
+              (SELECT count(*) FROM js
+                JOIN reservation_slots rs ON (rs.kind, rs.day, rs.time) = (js.kind, js.day, js.time)
+               WHERE rs.submission_id <> js.id
+              ) AS held_by_other,
+              (SELECT count(*) FROM reservation_slots rs
+                 JOIN submissions s ON s.id = rs.submission_id
+                WHERE s.schedule_rule IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM js
+                                   WHERE js.id = rs.submission_id AND js.day = rs.day AND js.time = rs.time)
+              ) AS slot_without_json
+        """)).mappings().one()
+    print(f"live: json_without_slot={r['json_without_slot']} held_by_other={r['held_by_other']} "
+          f"slot_without_json={r['slot_without_json']}")
+    return r["json_without_slot"] == 0 and r["slot_without_json"] == 0
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--submissions", type=int, default=2000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--live", action="store_true", help="実 DB のデータも照合する（読み取りのみ）")
+    args = ap.parse_args()
+
+    ok = check_backfill(args.submissions, args.seed)
+    if args.live:
+        ok = check_live() and ok
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())